@@ -8,6 +8,13 @@ adev()
         unset ANDROID_SERIAL
     fi
 }
+
+adev.py -x [-j JOBS] [-t TIMEOUT] DEVICES ADB_ARGS...
+    runs `adb -s SERIAL ADB_ARGS...` on the devices matching DEVICES (`all`, or comma separated
+    numbers/names as for adev) concurrently, e.g. adev.py -x all shell getprop ro.build.version.sdk
+
+adev.py --test
+    checks the adb server protocol and the device cache against a fake adb server
 """
 
 __version__ = '1.0'
@@ -16,13 +23,93 @@ __author__ = 'phus.lu@gmail.com'
 import sys
 import os
 import re
+import time
+import json
+import socket
 import difflib
+import argparse
+import threading
+import subprocess
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+PY3 = sys.version >= '3'
+ADB_HOST = '127.0.0.1'
+ADB_PORT = int(os.environ.get('ANDROID_ADB_SERVER_PORT') or 5037)
+CACHE_FILE = os.path.expanduser('~/.cache/adev.json')
+# long enough for the adev + adb commands typed right after, short enough to notice a replug
+CACHE_TTL = 3
+FANOUT_JOBS = 8
+FANOUT_TIMEOUT = 300
+
+_device_lines = None
+
+class AdbError(Exception):
+    pass
+
+def adb_query(service, host=None, port=None, timeout=2):
+    """one host service request over the adb server smart socket, returns the payload"""
+    sock = socket.create_connection((host or ADB_HOST, port or ADB_PORT), timeout=timeout)
+    try:
+        sock.sendall(('%04x%s' % (len(service), service)).encode('ascii'))
+        fp = sock.makefile('rb')
+        status = fp.read(4)
+        length = fp.read(4)
+        data = fp.read(int(length, 16)) if re.match(br'^[0-9a-fA-F]{4}$', length) else b''
+        if status != b'OKAY':
+            raise AdbError('%s %r: %r' % (service, status, data))
+        return data.decode('utf-8', 'replace')
+    finally:
+        sock.close()
+
+def read_cache():
+    try:
+        with open(CACHE_FILE, 'r') as fp:
+            cache = json.load(fp)
+        if cache['port'] == ADB_PORT and 0 <= time.time() - cache['time'] < CACHE_TTL:
+            return [str(x) for x in cache['lines']]
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def write_cache(lines):
+    try:
+        if not os.path.isdir(os.path.dirname(CACHE_FILE)):
+            os.makedirs(os.path.dirname(CACHE_FILE))
+        with open(CACHE_FILE + '.tmp', 'w') as fp:
+            json.dump({'port': ADB_PORT, 'time': time.time(), 'lines': lines}, fp)
+        os.rename(CACHE_FILE + '.tmp', CACHE_FILE)
+    except (IOError, OSError):
+        pass
+
+def device_lines(refresh=False):
+    """`adb devices -l` lines, taken once per run from the cache, the adb server or the adb command"""
+    global _device_lines
+    if _device_lines is not None and not refresh:
+        return _device_lines
+    lines = None if refresh else read_cache()
+    if lines is None:
+        try:
+            lines = adb_query('host:devices-l').strip().splitlines()
+        except (socket.error, AdbError):
+            # no server yet, the adb command starts one
+            output = os.popen('adb devices -l').read().strip().splitlines()
+            if not output or not output[0].startswith('List of devices'):
+                sys.stderr.write('\033[41mPlease add android SDK to PATH.\033[0m\n')
+                sys.exit(-1)
+            lines = output[1:]
+        lines = [x for x in lines if x.strip()]
+        write_cache(lines)
+    _device_lines = lines
+    return lines
 
 def list_devices():
-    return [x.split()[0] for x in os.popen('adb devices').read().strip().splitlines()[1:]]
+    return [x.split()[0] for x in device_lines()]
 
 def print_devices(current_device=None):
-    lines = os.popen('adb devices').read().strip().splitlines()[1:]
+    lines = device_lines()
     for i, line in enumerate(lines, 1):
         if current_device and current_device in line:
             output = '\033[92m * %d. %s \033[0m' % (i, line)
@@ -31,19 +118,21 @@ def print_devices(current_device=None):
         sys.stderr.write(output+'\n')
 
 def pre_start():
-    current_device = os.environ.get('ANDROID_SERIAL', '')
-    try:
-        if not os.popen('adb version').read().strip().startswith('Android Debug'):
-            sys.stderr.write('\033[41mPlease add android SDK to PATH.\033[0m\n')
-            sys.exit(-1)
-        devices = list_devices()
-        if not devices:
-            sys.stderr.write('\033[41mNO android devices connected.\033[0m\n')
-            sys.exit(-1)
-    except Exception as e:
-        pass
-    finally:
-        pass
+    if not device_lines():
+        sys.stderr.write('\033[41mNO android devices connected.\033[0m\n')
+        sys.exit(-1)
+
+def match_device(arg, devices):
+    """the device with serial arg, else numbered or closest named by arg, None when nothing matches"""
+    if arg in devices:
+        return arg
+    if arg.isdigit():
+        # a number never falls back to a fuzzy name match, that would pick some other device
+        return devices[int(arg)-1] if 1 <= int(arg) <= len(devices) else None
+    elif len(arg) >= 2:
+        matches = difflib.get_close_matches(arg, devices, n=1, cutoff=0.1)
+        return matches[0] if matches else None
+    return None
 
 def parse_device_from_args():
     device  = None
@@ -51,14 +140,118 @@ def parse_device_from_args():
     if len(devices) == 1:
         device = devices[0]
     elif len(sys.argv) > 1:
-        arg = sys.argv[1] 
-        if arg in '123456789' and int(arg) <= len(devices):
-            device = devices[int(sys.argv[1])-1]
-        elif len(arg) >= 2:
-            matches = difflib.get_close_matches(arg, devices, n=1, cutoff=0.1)
-            device = matches[0] if matches else os.environ.get('ANDROID_SERIAL', '')
+        arg = sys.argv[1]
+        device = match_device(arg, devices)
+        if device is None and len(arg) >= 2:
+            device = os.environ.get('ANDROID_SERIAL', '')
     return device
 
+def match_devices(pattern, devices):
+    """devices of pattern, None when an entry of it matches nothing"""
+    if pattern == 'all':
+        return list(devices)
+    matched = []
+    for arg in pattern.split(','):
+        device = match_device(arg.strip(), devices)
+        if device is None:
+            sys.stderr.write('\033[41mno device matches %r.\033[0m\n' % arg)
+            return None
+        if device not in matched:
+            matched.append(device)
+    return matched
+
+class FanoutResult(object):
+    def __init__(self, device):
+        self.device = device
+        self.status = None
+        self.duration = 0
+        self.timed_out = False
+
+def fanout(devices, args, jobs=FANOUT_JOBS, timeout=FANOUT_TIMEOUT, output=sys.stdout):
+    """runs `adb -s DEVICE args` on devices, at most jobs at a time, output lines prefixed with the device"""
+    results = [FanoutResult(x) for x in devices]
+    pending = Queue.Queue()
+    for result in results:
+        pending.put(result)
+    width = max(len(x) for x in devices)
+    lock = threading.Lock()
+
+    def run(result):
+        start = time.time()
+        try:
+            proc = subprocess.Popen(['adb', '-s', result.device] + list(args), stdin=open(os.devnull, 'rb'), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid if os.name != 'nt' else None)
+        except OSError as e:
+            with lock:
+                output.write('%-*s | %s\n' % (width, result.device, e))
+            result.status = 0x7f
+            return
+        def kill():
+            result.timed_out = True
+            try:
+                # its own session, so whatever adb forked goes too and nothing holds the pipe open
+                if os.name != 'nt':
+                    os.killpg(proc.pid, 9)
+                else:
+                    proc.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            for line in iter(proc.stdout.readline, b''):
+                line = line.rstrip(b'\r\n')
+                if PY3:
+                    line = line.decode('utf-8', 'replace')
+                with lock:
+                    output.write('%-*s | %s\n' % (width, result.device, line))
+                    output.flush()
+            result.status = proc.wait()
+        finally:
+            timer.cancel()
+            timer.join()
+            result.duration = time.time() - start
+
+    def worker():
+        while True:
+            try:
+                result = pending.get_nowait()
+            except Queue.Empty:
+                return
+            run(result)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(jobs, len(devices)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        # a timed join keeps ctrl-c working
+        while t.is_alive():
+            t.join(1)
+    return results
+
+def print_fanout_summary(results):
+    for result in results:
+        status = 'timeout' if result.timed_out else str(result.status)
+        color = '92' if result.status == 0 and not result.timed_out else '91'
+        sys.stderr.write('\033[%sm %-22s %8s %8.2fs \033[0m\n' % (color, result.device, status, result.duration))
+
+def fanout_main(argv):
+    parser = argparse.ArgumentParser(prog='adev.py -x', description='run an adb command on many devices concurrently')
+    parser.add_argument('-j', '--jobs', type=int, default=FANOUT_JOBS, help='devices at a time')
+    parser.add_argument('-t', '--timeout', type=float, default=FANOUT_TIMEOUT, help='seconds per device')
+    parser.add_argument('devices', help='all, or comma separated device numbers/names')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='adb arguments, e.g. shell getprop')
+    args = parser.parse_args(argv)
+    if not args.args:
+        parser.error('no adb arguments')
+    pre_start()
+    devices = match_devices(args.devices, list_devices())
+    if not devices:
+        sys.exit(-1)
+    results = fanout(devices, args.args, max(args.jobs, 1), args.timeout)
+    print_fanout_summary(results)
+    sys.exit(0 if all(x.status == 0 and not x.timed_out for x in results) else 1)
+
 def main():
     pre_start()
     current_device = os.environ.get('ANDROID_SERIAL', '')
@@ -72,7 +265,7 @@ def main():
             try:
                 print_devices(current_device)
                 sys.stderr.write('\nselect device number: ')
-                n = int(raw_input(''))
+                n = int(input('') if PY3 else raw_input(''))
                 device = devices[n-1]
                 sys.stderr.write('\033[92m * %s \033[0m been selected.\n' % device)
             except (IndexError, ValueError, KeyboardInterrupt):
@@ -83,6 +276,62 @@ def main():
         print_devices(None)
         sys.stdout.write('')
 
+def _test():
+    """device_lines() against a fake adb server on a free port, then from the cache with the server gone"""
+    global ADB_PORT, CACHE_FILE, _device_lines
+    import tempfile
+    payload = ''.join('%-22s device product:p%d model:m%d device:d%d transport_id:%d\n' % ('serial%02d' % i, i, i, i, i) for i in range(60))
+    server = socket.socket()
+    server.bind((ADB_HOST, 0))
+    server.listen(8)
+    requests = []
+
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            request = conn.recv(4096)
+            requests.append(request)
+            if request == b'000ehost:devices-l':
+                conn.sendall(('OKAY%04x%s' % (len(payload), payload)).encode('ascii'))
+            else:
+                conn.sendall(b'FAIL0007unknown')
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    ADB_PORT = server.getsockname()[1]
+    CACHE_FILE = os.path.join(tempfile.mkdtemp(prefix='adev_'), 'adev.json')
+    try:
+        assert adb_query('host:devices-l') == payload
+        try:
+            adb_query('host:bogus')
+            raise AssertionError('FAIL status not raised')
+        except AdbError:
+            pass
+        devices = list_devices()
+        assert devices == ['serial%02d' % i for i in range(60)], devices
+        assert device_lines()[59].split()[-1] == 'transport_id:59'
+        assert len(requests) == 3, requests
+        assert match_device('15', devices) == 'serial14' and match_device('61', devices) is None
+        # a serial of digits is taken as a serial before it is taken as a number
+        assert match_device('98765', ['1', '98765']) == '98765' and match_device('1', ['98765', '1']) == '1'
+        assert match_devices('1,13,60', devices) == ['serial00', 'serial12', 'serial59']
+        assert match_devices('1,61', devices) is None
+        server.close()
+        _device_lines = None
+        assert list_devices() == devices
+        assert len(requests) == 3, requests
+    finally:
+        os.remove(CACHE_FILE)
+        os.rmdir(os.path.dirname(CACHE_FILE))
+    print('adb server protocol and device cache ok')
+
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] == ['-x']:
+        fanout_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['--test']:
+        _test()
+    else:
+        main()
 
@@ -7,66 +7,215 @@ PY3 = sys.version >= '3'
 if not PY3:
     reload(sys).setdefaultencoding('utf-8')
 
-import base64
-import email.utils
-import getopt
-import hashlib
-import json
-import logging
 import os
-import re
-import socket
-import struct
-import sys
-import telnetlib
-import threading
-import time
 
-if PY3:
-    from urllib.request import urlopen, Request
-    from queue import Queue
-    from itertools import zip_longest
-else:
-    from urllib2 import urlopen, Request
-    from Queue import Queue
-    from itertools import izip_longest as zip_longest
 
-logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+def _logging():
+    """import and configure logging on first use, keeps it off the startup path"""
+    import logging
+    if not logging.root.handlers:
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+    return logging
+
+
+AES_CHUNK_SIZE = 48 * 4096
 
 
-def aes_encrypt(key, iv):
+def _aes_cipher(key, iv):
     from Crypto.Cipher import AES
-    text = sys.stdin.read()
-    BS = AES.block_size
-    pad = lambda s: s + (BS - len(s) % BS) * chr(BS - len(s) % BS)
-    # unpad = lambda s : s[0:-ord(s[-1])]
-    print(base64.b64encode(AES.new(key,  AES.MODE_CBC, iv).encrypt(pad(text))).decode())
+    if PY3:
+        key, iv = key.encode(), iv.encode()
+    return AES.new(key, AES.MODE_CBC, iv)
+
+
+class _Base64Writer(object):
+    """incremental base64, the output equals one b64encode() over all data"""
 
+    def __init__(self, fp):
+        import base64
+        self.b64encode = base64.b64encode
+        self.fp = fp
+        self.rest = b''
+
+    def write(self, data):
+        data = self.rest + data
+        size = len(data) - len(data) % 3
+        self.fp.write(self.b64encode(data[:size]))
+        self.rest = data[size:]
+
+    def close(self):
+        self.fp.write(self.b64encode(self.rest) + b'\n')
+        self.fp.flush()
+
+
+def _base64_reader(fp):
+    import base64
+    rest = b''
+    while True:
+        data = fp.read(AES_CHUNK_SIZE)
+        if not data:
+            break
+        data = rest + b''.join(data.split())
+        size = len(data) - len(data) % 4
+        yield base64.b64decode(data[:size])
+        rest = data[size:]
+    if rest:
+        raise ValueError('truncated base64 input')
 
-def wol(mac='18:66:DA:17:A2:95', broadcast='192.168.2.255'):
+
+def aes_encrypt(key, iv, raw=False):
+    """AES-CBC with PKCS#7 padding over stdin in constant memory, base64 output unless --raw"""
+    cipher = _aes_cipher(key, iv)
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    out = stdout if raw else _Base64Writer(stdout)
+    BS = 16
+    pending = b''
+    while True:
+        data = stdin.read(AES_CHUNK_SIZE)
+        if not data:
+            break
+        pending += data
+        size = len(pending) - len(pending) % BS
+        # the cipher object carries the CBC chaining state between calls
+        out.write(cipher.encrypt(pending[:size]))
+        pending = pending[size:]
+    padding = BS - len(pending)
+    out.write(cipher.encrypt(pending + bytes(bytearray([padding] * padding))))
+    if raw:
+        stdout.flush()
+    else:
+        out.close()
+
+
+def aes_decrypt(key, iv, raw=False):
+    """reverse of aes_encrypt, reads base64 from stdin unless --raw"""
+    cipher = _aes_cipher(key, iv)
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    chunks = iter(lambda: stdin.read(AES_CHUNK_SIZE), b'') if raw else _base64_reader(stdin)
+    BS = 16
+    pending = b''
+    for data in chunks:
+        pending += data
+        # hold back the last block, it carries the padding
+        size = max(len(pending) - len(pending) % BS - BS, 0)
+        stdout.write(cipher.decrypt(pending[:size]))
+        pending = pending[size:]
+    if len(pending) != BS:
+        raise ValueError('ciphertext is not a multiple of %d bytes' % BS)
+    data = cipher.decrypt(pending)
+    padding = bytearray(data[-1:])[0]
+    if not 1 <= padding <= BS or data[-padding:] != data[-1:] * padding:
+        raise ValueError('bad PKCS#7 padding')
+    stdout.write(data[:-padding])
+    stdout.flush()
+
+
+def _wol_packet(mac):
     if len(mac) == 12:
         pass
     elif len(mac) == 12 + 5:
         mac = mac.replace(mac[2], '')
     else:
         raise ValueError('Incorrect MAC address format')
-    data = ''.join(['FFFFFFFFFFFF', mac * 20])
-    send_data = b''
-    # Split up the hex values and pack.
-    for i in range(0, len(data), 2):
-        send_data = b''.join([send_data, struct.pack('B', int(data[i: i + 2], 16))])
-    # Broadcast it to the LAN.
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    sock.sendto(send_data, (broadcast, 7))
-    logging.info('wol packet sent to MAC=%r', mac)
+    import binascii
+    try:
+        return mac, binascii.unhexlify('FFFFFFFFFFFF' + mac * 20)
+    except (TypeError, ValueError):
+        raise ValueError('Incorrect MAC address format')
 
 
-def capture(url, wait_for_text='', selector='body', viewport_size='800x450', filename='capture.png'):
-    """see https://hub.docker.com/r/phuslu/ghost.py/"""
+def wol(mac='18:66:DA:17:A2:95', broadcast='192.168.2.255', file='', port='7', interface='', repeat='1', interval='0'):
+    """wake one MAC, or every "MAC [BROADCAST [INTERFACE]]" line of --file (- for stdin)
+
+    every target is sent --repeat times, with --interval seconds between packets
+    """
+    import socket
+    import time
+    logging = _logging()
+    targets = []
+    if file:
+        fp = sys.stdin if file == '-' else open(file)
+        for line in fp:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                targets.append((fields[0], fields[1] if len(fields) > 1 else broadcast, fields[2] if len(fields) > 2 else interface))
+        if fp is not sys.stdin:
+            fp.close()
+    else:
+        targets.append((mac, broadcast, interface))
+    packets = [(_wol_packet(mac), (broadcast, int(port)), iface) for mac, broadcast, iface in targets]
+    interval = float(interval)
+    socks = {}
+    count = 0
+    start = time.time()
+    try:
+        for _ in range(int(repeat)):
+            for (mac, data), addr, iface in packets:
+                if count and interval:
+                    time.sleep(interval)
+                sock = socks.get(iface)
+                if sock is None:
+                    # one broadcast socket per interface, shared by all its targets
+                    sock = socks[iface] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                    if iface:
+                        sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_BINDTODEVICE', 25), iface.encode())
+                sock.sendto(data, addr)
+                count += 1
+                if not file:
+                    logging.info('wol packet sent to MAC=%r', mac)
+    finally:
+        for sock in socks.values():
+            sock.close()
+    if file:
+        logging.info('sent %d wol packets to %d MACs in %.3fs', count, len(packets), time.time() - start)
+
+
+def _test_wol():
+    """wol --file with --repeat against a udp listener on loopback
+
+    python -c 'import bb; bb._test_wol()'
+    """
+    import binascii
+    import socket
+    import tempfile
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.settimeout(5)
+    port = listener.getsockname()[1]
+    macs = ['18:66:DA:17:A2:95', '00-11-22-33-44-55', 'AABBCCDDEEFF']
+    fd, filename = tempfile.mkstemp(prefix='bb_wol_')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('# lab machines\n%s 127.0.0.1\n\n%s\n%s 127.0.0.1  # rack 2\n' % tuple(macs))
+        wol(broadcast='127.0.0.1', file=filename, port=str(port), repeat='3')
+        packets = [listener.recv(1024) for _ in range(len(macs) * 3)]
+        listener.settimeout(0.2)
+        try:
+            extra = listener.recv(1024)
+            raise AssertionError('unexpected packet %r' % extra)
+        except socket.timeout:
+            pass
+    finally:
+        listener.close()
+        os.remove(filename)
+    for mac in macs:
+        raw = binascii.unhexlify(mac.replace(':', '').replace('-', ''))
+        expected = b'\xff' * 6 + raw * 20
+        assert packets.count(expected) == 3, (mac, packets)
+    print('wol ok, %d packets' % len(packets))
+
+
+def _capture_session(viewport_size):
     import ghost
-    logging.info('create ghost.py Session')
-    session = ghost.Session(ghost.Ghost(), viewport_size=tuple(map(int, viewport_size.split('x'))))
+    _logging().info('create ghost.py Session')
+    return ghost.Session(ghost.Ghost(), viewport_size=tuple(map(int, viewport_size.split('x'))))
+
+
+def _capture_open(session, url, wait_for_text=''):
+    logging = _logging()
     logging.info('open %r', url)
     session.open(url)
     if wait_for_text:
@@ -75,23 +224,303 @@ def capture(url, wait_for_text='', selector='body', viewport_size='800x450', fil
     else:
         logging.info('wait_for_page_loaded')
         session.wait_for_page_loaded()
-    if '/' not in filename:
-        filename = '/data/' + filename
-    logging.info('capture selector=%r to %r', selector, filename)
+    return session.content
+
+
+def _capture_save(session, content, selector, filename):
+    _logging().info('capture selector=%r to %r', selector, filename)
     session.capture_to(filename, selector=selector)
     os.chmod(filename, 0o666)
     htmlfile = os.path.splitext(filename)[0] + '.html'
-    open(htmlfile, 'wb').write(session.content.encode('utf-8'))
+    with open(htmlfile, 'wb') as fp:
+        fp.write(content.encode('utf-8'))
     os.chmod(htmlfile, 0o666)
 
 
-def tcptop(pid=None, no_port=False, interval='1'):
-    if not os.environ.get('WATCHED'):
-        os.environ['WATCHED'] = '1'
-        os.execv('/usr/bin/watch', ['watch', '-n' + interval, ' '.join(sys.argv)])
+def capture(url, wait_for_text='', selector='body', viewport_size='800x450', filename='capture.png'):
+    """see https://hub.docker.com/r/phuslu/ghost.py/"""
+    session = _capture_session(viewport_size)
+    content = _capture_open(session, url, wait_for_text)
+    if '/' not in filename:
+        filename = '/data/' + filename
+    _capture_save(session, content, selector, filename)
+
+
+# warm ghost.py session of a capture_batch worker process
+_capture_worker_session = None
+_capture_worker_viewport_size = None
+
+
+def _capture_worker_init(viewport_size):
+    global _capture_worker_viewport_size
+    _capture_worker_viewport_size = viewport_size
+
+
+def _capture_worker(task):
+    global _capture_worker_session
+    import hashlib
+    url, filename, wait_for_text, selector, last_digest = task
+    try:
+        if _capture_worker_session is None:
+            # not in the pool initializer, a failure there makes the pool respawn workers forever
+            _capture_worker_session = _capture_session(_capture_worker_viewport_size)
+        content = _capture_open(_capture_worker_session, url, wait_for_text)
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        if digest == last_digest and os.path.exists(filename):
+            return url, digest, 'unchanged'
+        _capture_save(_capture_worker_session, content, selector, filename)
+        return url, digest, 'captured'
+    except Exception as e:
+        _logging().exception('capture %r failed: %r', url, e)
+        return url, last_digest, 'failed'
+
+
+def capture_batch(urls, wait_for_text='', selector='body', viewport_size='800x450', directory='/data', workers='4'):
+    """capture every "URL [FILENAME]" line of --urls (- for stdin) with a pool of warm sessions
+
+    pages whose content hash matches the previous run (DIRECTORY/capture.json) are skipped
+    """
+    import json
+    import multiprocessing
+    import re
+    logging = _logging()
+    fp = sys.stdin if urls == '-' else open(urls)
+    tasks = []
+    for line in fp:
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        url = fields[0]
+        filename = fields[1] if len(fields) > 1 else re.sub(r'[^\w.-]+', '_', url.split('://', 1)[-1]).strip('_')[:200] + '.png'
+        if '/' not in filename:
+            filename = os.path.join(directory, filename)
+        tasks.append((url, filename))
+    if fp is not sys.stdin:
+        fp.close()
+    manifest_file = os.path.join(directory, 'capture.json')
+    try:
+        with open(manifest_file) as fp:
+            manifest = json.load(fp)
+    except (IOError, ValueError):
+        manifest = {}
+    tasks = [(url, filename, wait_for_text, selector, manifest.get(url)) for url, filename in tasks]
+    pool = multiprocessing.Pool(min(int(workers), len(tasks)) or 1, _capture_worker_init, (viewport_size,))
+    stats = {}
+    try:
+        for url, digest, status in pool.imap_unordered(_capture_worker, tasks):
+            logging.info('%s %r', status, url)
+            stats[status] = stats.get(status, 0) + 1
+            if digest:
+                manifest[url] = digest
+    finally:
+        pool.terminate()
+    with open(manifest_file + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.rename(manifest_file + '.tmp', manifest_file)
+    logging.info('capture_batch %d urls: %s', len(tasks), ', '.join('%s=%d' % x for x in sorted(stats.items())))
+
+
+def _test_capture_batch():
+    """capture_batch against fixture pages on a local http server, with a stand-in for the ghost module
+
+    python -c 'import bb; bb._test_capture_batch()'
+    """
+    import json
+    import shutil
+    import tempfile
+    import threading
+    import types
+    if PY3:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from urllib.request import urlopen
+    else:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from urllib2 import urlopen
+    pages = {'/a.html': u'<p>a</p>', '/b.html': u'<p>b</p>'}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = pages.get(self.path)
+            self.send_response(200 if body else 404)
+            self.end_headers()
+            self.wfile.write((body or u'not found').encode('utf-8'))
+
+        def log_message(self, *args):
+            pass
+
+    class Session(object):
+        def __init__(self, ghost, viewport_size):
+            self.content = u''
+
+        def open(self, url):
+            self.content = urlopen(url).read().decode('utf-8')
+
+        def wait_for_page_loaded(self):
+            pass
+
+        def capture_to(self, filename, selector):
+            with open(filename, 'wb') as fp:
+                fp.write(self.content.encode('utf-8'))
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:%d' % server.server_address[1]
+    directory = tempfile.mkdtemp(prefix='bb_capture_')
+    ghost = sys.modules.get('ghost')
+
+    def run():
+        # in a thread with a deadline, a broken pool must fail the test instead of hanging it
+        done = []
+        t = threading.Thread(target=lambda: done.append(capture_batch(urls, directory=directory, workers='2')))
+        t.daemon = True
+        t.start()
+        t.join(60)
+        assert done, 'capture_batch did not return'
+        with open(os.path.join(directory, 'capture.json')) as fp:
+            return json.load(fp)
+
+    try:
+        urls = os.path.join(directory, 'urls.txt')
+        with open(urls, 'w') as fp:
+            fp.write('# fixtures\n%s/a.html a.png\n%s/b.html b.png\n%s/missing.html\n' % (base, base, base))
+        sys.modules['ghost'] = types.ModuleType('ghost')
+        sys.modules['ghost'].Ghost = object
+        sys.modules['ghost'].Session = Session
+        manifest = run()
+        assert sorted(manifest) == [base + '/a.html', base + '/b.html'], manifest
+        a_png = os.path.join(directory, 'a.png')
+        os.utime(a_png, (0, 0))
+        pages['/b.html'] = u'<p>b changed</p>'
+        manifest = run()
+        assert os.path.getmtime(a_png) == 0, 'unchanged page captured again'
+        with open(os.path.join(directory, 'b.png'), 'rb') as fp:
+            assert fp.read() == b'<p>b changed</p>'
+        # ghost.py failing to start gives failed captures, the manifest keeps the last good digests
+        sys.modules['ghost'] = None
+        assert run() == manifest
+    finally:
+        if ghost is None:
+            sys.modules.pop('ghost', None)
+        else:
+            sys.modules['ghost'] = ghost
+        server.shutdown()
+        shutil.rmtree(directory)
+    print('capture_batch ok')
+
+
+INET_DIAG_INFO = 2
+SOCK_DIAG_BY_FAMILY = 20
+NETLINK_SOCK_DIAG = 4
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+TCP_ESTABLISHED = 1
+
+# exporter series without connections for this many seconds are dropped, and at most this many are kept per table
+TCPTOP_SERIES_EXPIRE = 300
+TCPTOP_MAX_SERIES = 10000
+
+_tcptop_inodes = {}
+
+
+def _tcptop_scan_inodes(pid=None):
+    """map socket inodes to (pid, comm) with one pass over /proc/*/fd"""
+    inodes = {}
+    for apid in ([pid] if pid else os.listdir('/proc')):
+        if not apid.isdigit():
+            continue
+        fddir = '/proc/%s/fd/' % apid
+        try:
+            fds = os.listdir(fddir)
+            with open('/proc/%s/comm' % apid) as fp:
+                comm = fp.read().strip()
+        except (IOError, OSError):
+            continue
+        for fd in fds:
+            try:
+                link = os.readlink(fddir + fd)
+            except OSError:
+                continue
+            if link.startswith('socket:['):
+                inodes[int(link[8:-1])] = (apid, comm)
+    return inodes
+
+
+def _tcptop_format_addr(family, raw, port):
+    import socket
+    if family == socket.AF_INET:
+        return '%s:%d' % (socket.inet_ntop(family, raw[:4]), port)
+    addr = socket.inet_ntop(family, raw)
+    if addr.startswith('::ffff:') and '.' in addr:
+        return '%s:%d' % (addr[7:], port)
+    return '[%s]:%d' % (addr, port)
+
+
+def _tcptop_host(addr):
+    host = addr.rsplit(':', 1)[0].strip('[]')
+    return host[7:] if host.startswith('::ffff:') else host
+
+
+def _tcptop_netlink(pid=None):
+    """dump established tcp sockets and their tcp_info via NETLINK_SOCK_DIAG"""
+    import socket
+    import struct
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG)
+    rescanned = False
+    try:
+        for seq, family in enumerate((socket.AF_INET, socket.AF_INET6), 1):
+            # struct nlmsghdr + struct inet_diag_req_v2
+            req = struct.pack('=BBBBI48x', family, socket.IPPROTO_TCP, 1 << (INET_DIAG_INFO - 1), 0, 1 << TCP_ESTABLISHED)
+            sock.send(struct.pack('=IHHII', 16 + len(req), SOCK_DIAG_BY_FAMILY, 0x301, seq, 0) + req)
+            done = False
+            while not done:
+                data = sock.recv(1 << 20)
+                offset = 0
+                while offset + 16 <= len(data):
+                    msg_len, msg_type = struct.unpack_from('=IH', data, offset)
+                    if msg_type == NLMSG_DONE:
+                        done = True
+                        break
+                    if msg_type == NLMSG_ERROR:
+                        error = -struct.unpack_from('=i', data, offset + 16)[0]
+                        raise socket.error(error, os.strerror(error))
+                    # struct inet_diag_msg
+                    msg = offset + 16
+                    family, state = struct.unpack_from('=BB', data, msg)
+                    sport, dport = struct.unpack_from('>HH', data, msg + 4)
+                    src, dst = data[msg + 8:msg + 24], data[msg + 24:msg + 40]
+                    inode, = struct.unpack_from('=I', data, msg + 68)
+                    bytes_acked = bytes_received = 0
+                    attr = msg + 72
+                    while attr + 4 <= offset + msg_len:
+                        rta_len, rta_type = struct.unpack_from('=HH', data, attr)
+                        if rta_len < 4:
+                            break
+                        # struct tcp_info, bytes_acked/bytes_received need linux 4.1+
+                        if rta_type == INET_DIAG_INFO and rta_len >= 4 + 136:
+                            bytes_acked, bytes_received = struct.unpack_from('=QQ', data, attr + 4 + 120)
+                        attr += (rta_len + 3) & ~3
+                    if inode and inode not in _tcptop_inodes and not rescanned:
+                        # one /proc scan per dump, also drops inodes of closed sockets
+                        _tcptop_inodes.clear()
+                        _tcptop_inodes.update(_tcptop_scan_inodes(pid))
+                        rescanned = True
+                    apid, comm = _tcptop_inodes.get(inode, ('-', '-'))
+                    yield ('ESTAB' if state == TCP_ESTABLISHED else str(state),
+                           _tcptop_format_addr(family, src, sport),
+                           _tcptop_format_addr(family, dst, dport),
+                           apid, comm, bytes_acked, bytes_received)
+                    offset += (msg_len + 3) & ~3
+    finally:
+        sock.close()
+
+
+def _tcptop_ss(pid=None):
+    """fallback parser of `ss -ntpi` output"""
+    import re
     lines = os.popen('ss -ntpi').read().splitlines()
     lines.pop(0)
-    info = {}
     for i in range(0, len(lines), 2):
         line, next_line = lines[i], lines[i+1]
         state, _, _, laddr, raddr = line.split()[:5]
@@ -101,11 +530,25 @@ def tcptop(pid=None, no_port=False, interval='1'):
             m = re.search(r'"(.+?)".+pid=(\d+)', line)
             comm, apid = m.group(1, 2)
         metrics = dict((k,int(v) if re.match(r'^\d+$', v) else v) for k, v in re.findall(r'([a-z_]+):(\S+)', next_line))
-        bytes_acked = metrics.get('bytes_acked', 0)
-        bytes_received = metrics.get('bytes_received', 0)
+        yield state, laddr, raddr, apid, comm, metrics.get('bytes_acked', 0), metrics.get('bytes_received', 0)
+
+
+def _tcptop_sockets(pid=None):
+    import socket
+    import struct
+    try:
+        return list(_tcptop_netlink(pid))
+    except (AttributeError, socket.error, struct.error) as e:
+        _logging().debug('tcptop netlink sock_diag failed: %r, fallback to ss', e)
+        return list(_tcptop_ss(pid))
+
+
+def _tcptop_info(pid=None, no_port=False):
+    info = {}
+    for state, laddr, raddr, apid, comm, bytes_acked, bytes_received in _tcptop_sockets(pid):
         if pid and apid != pid:
             continue
-        if laddr.startswith(('127.', 'fe80::', '::1')) or raddr.startswith(('127.', 'fe80::', '::1')):
+        if laddr.lstrip('[').startswith(('127.', 'fe80::', '::1')) or raddr.lstrip('[').startswith(('127.', 'fe80::', '::1')):
             continue
         if bytes_acked == 0 or bytes_received == 0:
             continue
@@ -113,13 +556,12 @@ def tcptop(pid=None, no_port=False, interval='1'):
             continue
         laddr = laddr.lstrip('::ffff:')
         raddr = raddr.lstrip('::ffff:')
-        if bytes_acked and bytes_received and state.startswith('ESTAB'):
-            info[laddr, raddr] = (apid, comm, bytes_acked, bytes_received)
+        info[laddr, raddr] = (apid, comm, bytes_acked, bytes_received)
     if no_port:
         new_info = {}
         for (laddr, raddr), (pid, comm, bytes_acked, bytes_received) in info.items():
-            laddr = laddr.rsplit(':', 1)[0].strip('[]').lstrip('::ffff:')
-            raddr = raddr.rsplit(':', 1)[0].strip('[]').lstrip('::ffff:')
+            laddr = _tcptop_host(laddr)
+            raddr = _tcptop_host(raddr)
             try:
                 parts = new_info[laddr, raddr]
                 parts[-2] += bytes_acked
@@ -128,50 +570,401 @@ def tcptop(pid=None, no_port=False, interval='1'):
             except KeyError:
                 new_info[laddr, raddr] = [pid, comm, bytes_acked, bytes_received]
         info = new_info
-    print("%-6s %-12s %-21s %-21s %6s %6s" % ("PID", "COMM", "LADDR", "RADDR", "RX_KB", "TX_KB"))
-    infolist = sorted(info.items(), key=lambda x:(-x[1][-2], -x[1][-1]))
-    for (laddr, raddr), (pid, comm, bytes_acked, bytes_received) in infolist:
+    return info
+
+
+def _tcptop_render(info, last_info, elapsed, top):
+    """format one screen, rates are computed against the previous sample"""
+    import heapq
+    rows = []
+    for key, (pid, comm, bytes_acked, bytes_received) in info.items():
         rx_kb  = bytes_received//1024
         tx_kb  = bytes_acked//1024
         if rx_kb == 0 or tx_kb == 0:
             continue
-        print("%-6s %-12.12s %-21s %-21s %6d %6d" % (pid, comm, laddr, raddr, rx_kb, tx_kb))
+        last = last_info.get(key)
+        if last and elapsed > 0:
+            rx_rate = max(bytes_received - last[-1], 0) / 1024.0 / elapsed
+            tx_rate = max(bytes_acked - last[-2], 0) / 1024.0 / elapsed
+        else:
+            rx_rate = tx_rate = 0.0
+        rows.append((rx_rate + tx_rate, bytes_acked, bytes_received, key, pid, comm, rx_kb, tx_kb, rx_rate, tx_rate))
+    lines = ["%-6s %-12s %-21s %-21s %6s %6s %8s %8s" % ("PID", "COMM", "LADDR", "RADDR", "RX_KB", "TX_KB", "RX_KB/s", "TX_KB/s")]
+    for _, _, _, (laddr, raddr), pid, comm, rx_kb, tx_kb, rx_rate, tx_rate in heapq.nlargest(top, rows, key=lambda x:x[:3]):
+        lines.append("%-6s %-12.12s %-21s %-21s %6d %6d %8.1f %8.1f" % (pid, comm, laddr, raddr, rx_kb, tx_kb, rx_rate, tx_rate))
+    return lines
 
 
-def __main():
-    applet = os.path.basename(sys.argv[0])
-    funcs = [v for v in globals().values() if type(v) is type(__main) and v.__module__ == '__main__' and not v.__name__.startswith('_')]
-    if not PY3:
-        for func in funcs:
-            setattr(func, '__doc__', getattr(func, 'func_doc'))
-            setattr(func, '__defaults__', getattr(func, 'func_defaults'))
-            setattr(func, '__code__', getattr(func, 'func_code'))
-    funcs = sorted(funcs, key=lambda x:x.__name__)
-    params = dict((f.__name__, list(zip_longest(f.__code__.co_varnames[:f.__code__.co_argcount][::-1], (f.__defaults__ or [])[::-1]))[::-1]) for f in funcs)
-    def usage(applet):
-        if applet == 'bb.py':
-            print('Usage: {0} <applet> [arguments]\n\nExamples:\n{1}\n'.format(applet, '\n'.join('\t{0} {1} {2}'.format(applet, k, ' '.join('--{0} {1}'.format(x.replace('_', '-'), x.upper() if y is None else repr(y)) for (x, y) in v)) for k, v in params.items())))
-        else:
-            print('\nUsage:\n\t{0} {1}'.format(applet, ' '.join('--{0} {1}'.format(x.replace('_', '-'), x.upper() if y is None else repr(y)) for (x, y) in params[applet])))
-    if '-h' in sys.argv or '--help' in sys.argv or (applet == 'bb.py' and not sys.argv[1:]):
-        return usage(applet)
-    if applet == 'bb.py':
-        applet = sys.argv[1]
-    for f in funcs:
-        if f.__name__ == applet:
-            break
+class _TcptopCounters(object):
+    """monotonic per-process and per-peer byte counters built from socket samples
+
+    a series without connections for `expire` seconds is dropped, and each table keeps at most max_series of them,
+    so label cardinality follows the live connections instead of everything ever seen.
+    """
+
+    def __init__(self, expire=TCPTOP_SERIES_EXPIRE, max_series=TCPTOP_MAX_SERIES):
+        self.expire = expire
+        self.max_series = max_series
+        self.last_info = {}
+        # name -> [rx, tx, last seen with a connection]
+        self.processes = {}
+        self.peers = {}
+        self.snapshot = (b'', b'{}')
+
+    def expire_series(self, table, now):
+        for name in [k for k, v in table.items() if now - v[2] > self.expire]:
+            del table[name]
+        if len(table) > self.max_series:
+            for name in sorted(table, key=lambda k: table[k][2])[:len(table) - self.max_series]:
+                del table[name]
+
+    def update(self, info):
+        import json
+        import time
+        now = time.time()
+        connections = {}
+        for key, (pid, comm, bytes_acked, bytes_received) in info.items():
+            last = self.last_info.get(key)
+            if last and last[0] == pid:
+                tx, rx = max(bytes_acked - last[-2], 0), max(bytes_received - last[-1], 0)
+            else:
+                tx, rx = bytes_acked, bytes_received
+            peer = _tcptop_host(key[1])
+            for table, name in ((self.processes, (pid, comm)), (self.peers, peer)):
+                counter = table.setdefault(name, [0, 0, now])
+                counter[0] += rx
+                counter[1] += tx
+                counter[2] = now
+            connections[pid, comm] = connections.get((pid, comm), 0) + 1
+        self.last_info = info
+        self.expire_series(self.processes, now)
+        self.expire_series(self.peers, now)
+        processes = sorted(self.processes.items())
+        peers = sorted(self.peers.items())
+        process_labels = ['{pid="%s",comm="%s"}' % (pid, comm.replace('\\', '\\\\').replace('"', '\\"')) for (pid, comm), _ in processes]
+        # each family is one group, its TYPE line and then its samples
+        families = [
+            ('tcptop_process_receive_bytes_total', 'counter', [(labels, x[1][0]) for labels, x in zip(process_labels, processes)]),
+            ('tcptop_process_transmit_bytes_total', 'counter', [(labels, x[1][1]) for labels, x in zip(process_labels, processes)]),
+            ('tcptop_process_connections', 'gauge', [(labels, connections.get(x[0], 0)) for labels, x in zip(process_labels, processes)]),
+            ('tcptop_peer_receive_bytes_total', 'counter', [('{raddr="%s"}' % peer, rx) for peer, (rx, tx, _) in peers]),
+            ('tcptop_peer_transmit_bytes_total', 'counter', [('{raddr="%s"}' % peer, tx) for peer, (rx, tx, _) in peers]),
+        ]
+        lines = []
+        for name, kind, samples in families:
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend('%s%s %d' % (name, labels, value) for labels, value in samples)
+        data = {
+            'time': now,
+            'processes': [dict(pid=pid, comm=comm, rx_bytes=rx, tx_bytes=tx, connections=connections.get((pid, comm), 0)) for (pid, comm), (rx, tx, _) in processes],
+            'peers': [dict(raddr=peer, rx_bytes=rx, tx_bytes=tx) for peer, (rx, tx, _) in peers],
+        }
+        # scrapers only read this tuple, swapping it is atomic
+        self.snapshot = (('\n'.join(lines) + '\n').encode(), json.dumps(data).encode())
+
+
+def _tcptop_exporter(listen, pid=None, interval=1.0, expire=TCPTOP_SERIES_EXPIRE):
+    import threading
+    import time
+    logging = _logging()
+    if PY3:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
     else:
-        return usage()
-    options = [x.replace('_','-')+'=' for x in f.__code__.co_varnames[:f.__code__.co_argcount]]
-    kwargs, _ =  getopt.gnu_getopt(sys.argv[1:], '', options)
-    kwargs = dict((k[2:].replace('-', '_'),v) for k, v in kwargs)
-    logging.debug('main %s(%s)', f.__name__, kwargs)
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    counters = _TcptopCounters(expire)
+
+    def sampler():
+        while True:
+            now = time.time()
+            try:
+                counters.update(_tcptop_info(pid))
+            except Exception as e:
+                logging.exception('tcptop exporter sample failed: %r', e)
+            time.sleep(max(interval - (time.time() - now), 0))
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            prometheus, json_data = counters.snapshot
+            if self.path == '/metrics':
+                body, content_type = prometheus, 'text/plain; version=0.0.4'
+            elif self.path in ('/metrics.json', '/json'):
+                body, content_type = json_data, 'application/json'
+            else:
+                return self.send_error(404)
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format, *args)
+
+    counters.update(_tcptop_info(pid))
+    t = threading.Thread(target=sampler)
+    t.daemon = True
+    t.start()
+    host, _, port = listen.rpartition(':')
+    server = HTTPServer((host or '127.0.0.1', int(port)), Handler)
+    logging.info('tcptop exporter serving /metrics and /metrics.json on %s:%s', *server.server_address[:2])
+    server.serve_forever()
+
+
+def tcptop(pid=None, no_port=False, interval='1', top='20', count='0', listen='', expire=str(TCPTOP_SERIES_EXPIRE)):
+    import time
+    interval = float(interval)
+    if listen:
+        return _tcptop_exporter(listen, pid, interval, float(expire))
+    top = int(top)
+    count = int(count)
+    last_info = {}
+    last_time = 0
+    tty = sys.stdout.isatty()
+    try:
+        while True:
+            now = time.time()
+            info = _tcptop_info(pid, no_port)
+            lines = _tcptop_render(info, last_info, now - last_time, top)
+            # keep only the current sample, closed connections are evicted here
+            last_info, last_time = info, now
+            if tty:
+                sys.stdout.write('\033[H' + '\033[K\n'.join(lines) + '\033[K\n\033[J')
+            else:
+                sys.stdout.write('\n'.join(lines) + '\n\n')
+            sys.stdout.flush()
+            count -= 1
+            if count == 0:
+                break
+            time.sleep(max(interval - (time.time() - now), 0))
+    except KeyboardInterrupt:
+        pass
+
+
+def true():
+    """do nothing, successfully"""
+
+
+def bench_startup(count='20', budget_ms='60'):
+    """measure dispatcher startup, fails when the median is over budget"""
+    import subprocess
+    import time
+    count = int(count)
+    budget_ms = float(budget_ms)
+    over = []
+    for argv in (['true'], ['wol', '--help']):
+        timings = []
+        for _ in range(count):
+            start = time.time()
+            with open(os.devnull, 'wb') as null:
+                subprocess.call([sys.executable, os.path.abspath(__file__)] + argv, stdout=null)
+            timings.append((time.time() - start) * 1000)
+        timings.sort()
+        median = timings[len(timings)//2]
+        print('%-24s min=%.1fms median=%.1fms max=%.1fms budget=%.0fms' % (' '.join(['bb.py'] + argv), timings[0], median, timings[-1], budget_ms))
+        if median > budget_ms:
+            over.append(argv[0])
+    if over:
+        sys.exit('startup over budget: %s' % ' '.join(over))
+
+
+# seconds a serve worker whose client went away gets to unwind from the SIGINT before it is killed
+SERVE_WORKER_GRACE = 2
+
+
+def _client(path, argv):
+    """forward argv, env and stdio fds to a resident `bb.py serve`, None if it is not running"""
+    import _socket
+    if not hasattr(_socket.socket, 'sendmsg'):
+        return None
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        # same framing as bbclient.c, "cwd\0argc\0argv...\0environ...\0"
+        payload = ''.join(x + '\0' for x in [os.getcwd(), str(len(argv))] + argv + ['%s=%s' % x for x in os.environ.items()])
+        payload = payload.encode('utf-8', 'surrogateescape')
+        payload = len(payload).to_bytes(4, 'big') + payload
+        # the worker writes straight into our stdout/stderr, so output streams as it is produced
+        sent = sock.sendmsg([payload], [(_socket.SOL_SOCKET, _socket.SCM_RIGHTS, b''.join(fd.to_bytes(4, sys.byteorder) for fd in (0, 1, 2)))])
+        sock.sendall(payload[sent:])
+    except OSError:
+        sock.close()
+        return None
+    code = b''
+    try:
+        while len(code) < 4:
+            data = sock.recv(4 - len(code))
+            if not data:
+                return 1
+            code += data
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        sock.close()
+    return int.from_bytes(code, 'big')
+
+
+def _serve_worker(conn):
+    import signal
+    import socket
+    import threading
+    import time
+    import traceback
+    fds = []
+    data, ancdata, _, _ = conn.recvmsg(65536, socket.CMSG_LEN(3 * 4))
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds += [int.from_bytes(cdata[i:i + 4], sys.byteorder) for i in range(0, len(cdata) - 3, 4)]
+    size = int.from_bytes(data[:4], 'big')
+    data = data[4:]
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return
+        data += chunk
+    fields = data.decode('utf-8', 'surrogateescape').split('\0')
+    argc = int(fields[1])
+    os.chdir(fields[0])
+    os.environ.clear()
+    os.environ.update(x.split('=', 1) for x in fields[2 + argc:] if '=' in x)
+    for i, fd in enumerate(fds):
+        os.dup2(fd, i)
+        os.close(fd)
+    sys.argv = fields[2:2 + argc]
+    finished = threading.Event()
+
+    def watch():
+        # the client sends nothing more, eof means it exited or was interrupted: stop like a local ctrl-c
+        try:
+            while conn.recv(4096):
+                pass
+        except OSError:
+            pass
+        if finished.is_set():
+            return
+        os.kill(os.getpid(), signal.SIGINT)
+        time.sleep(SERVE_WORKER_GRACE)
+        os._exit(130)
+
+    watcher = threading.Thread(target=watch)
+    watcher.daemon = True
+    watcher.start()
+    try:
+        code = _dispatch(sys.argv) or 0
+    except KeyboardInterrupt:
+        code = 130
+    except SystemExit as e:
+        code = e.code
+        if code is not None and not isinstance(code, int):
+            sys.stderr.write('%s\n' % code)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finished.set()
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.sendall(((code or 0) & 0xff).to_bytes(4, 'big'))
+    except OSError:
+        pass
+
+
+def serve(path='', preload='base64,getopt,json,re,socket,struct,subprocess,threading,time,traceback'):
+    """resident applet server, bb.py and bbclient forward calls when BB_SERVER points at its socket"""
+    import gc
+    import signal
+    import socket
+    path = path or os.environ.get('BB_SERVER') or os.path.expanduser('~/.bb.py.sock')
+    for name in preload.split(','):
+        if name:
+            __import__(name)
+    logging = _logging()
+    if hasattr(gc, 'freeze'):
+        # keep preloaded objects out of gc, so forked workers do not copy their pages
+        gc.freeze()
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen(128)
+    # forked workers are reaped by the kernel
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    logging.info('bb.py serve on %r, export BB_SERVER=%s', path, path)
+    try:
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except InterruptedError:
+                continue
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if os.fork() == 0:
+                sock.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                try:
+                    _serve_worker(conn)
+                finally:
+                    os._exit(0)
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.remove(path)
+
+
+# applet table, options and defaults are read from the function signatures
+APPLETS = dict((f.__name__, f) for f in (
+    aes_decrypt,
+    aes_encrypt,
+    bench_startup,
+    capture,
+    capture_batch,
+    serve,
+    tcptop,
+    true,
+    wol,
+))
+
+
+def _usage(name):
+    f = APPLETS[name]
+    argnames = f.__code__.co_varnames[:f.__code__.co_argcount]
+    defaults = (None,) * (len(argnames) - len(f.__defaults__ or ())) + tuple(f.__defaults__ or ())
+    return ' '.join('--{0} {1}'.format(x.replace('_', '-'), x.upper() if y is None else repr(y)) for x, y in zip(argnames, defaults))
+
+
+def _dispatch(argv):
+    # busybox style, `ln -s bb.py wol` runs the wol applet
+    applet = os.path.splitext(os.path.basename(argv[0]))[0]
+    args = argv[1:]
+    if applet not in APPLETS:
+        applet, args = (args[0], args[1:]) if args else ('', [])
+    if applet not in APPLETS:
+        print('Usage: bb.py <applet> [arguments]\n\nExamples:\n{0}\n'.format('\n'.join('\tbb.py {0} {1}'.format(k, _usage(k)) for k in sorted(APPLETS))))
+        return 0 if applet in ('', '-h', '--help') else 1
+    f = APPLETS[applet]
+    if '-h' in args or '--help' in args:
+        print('\nUsage:\n\t{0} {1}'.format(applet, _usage(applet)))
+        return 0
+    kwargs = {}
+    if args:
+        import getopt
+        options = [x.replace('_','-')+'=' for x in f.__code__.co_varnames[:f.__code__.co_argcount]]
+        kwargs, _ =  getopt.gnu_getopt(args, '', options)
+        kwargs = dict((k[2:].replace('-', '_'),v) for k, v in kwargs)
     try:
         result = f(**kwargs)
     except TypeError as e:
+        import re
         patterns = [r'missing \d+ .* argument', r'takes (\w+ )+\d+ argument']
         if any(re.search(x, str(e)) for x in patterns):
-            return usage(applet)
+            print('\nUsage:\n\t{0} {1}'.format(applet, _usage(applet)))
+            return 1
         raise
     if type(result) == type(b''):
         result = result.decode().strip()
@@ -179,6 +972,14 @@ def __main():
         print(result)
 
 
-if __name__ == '__main__':
-    __main()
+def __main():
+    server = os.environ.get('BB_SERVER')
+    if server and 'serve' not in (os.path.splitext(os.path.basename(sys.argv[0]))[0], sys.argv[1:2] and sys.argv[1]):
+        code = _client(server, sys.argv)
+        if code is not None:
+            return code
+    return _dispatch(sys.argv)
 
+
+if __name__ == '__main__':
+    sys.exit(__main())
@@ -8,14 +8,144 @@ import time
 import logging
 import select
 import errno
+import collections
+import tempfile
 import subprocess
 
-def getstatusoutput(cmd, input='', callback=None, timeout=86400*2, **subprocess_args):
-    """getstatusoutput implemented by subprocess, works with gevent/eventlet. Author: @phuslu, LICENSE: public domain"""
-    timeout_at = time.time() + timeout
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+READ_SIZE = 65536
+
+# stdin of children without input, python2 has no DEVNULL and keeps the old closed pipe
+STDIN_NULL = getattr(subprocess, 'DEVNULL', subprocess.PIPE)
+
+# python3 fds are non-inheritable (PEP 446). CPython 3.10+ vforks with close_fds=True,
+# 3.8/3.9 only take the posix_spawn path with close_fds=False and an absolute executable.
+SPAWN_VFORK = getattr(subprocess, '_USE_VFORK', False)
+SPAWN_POSIX_SPAWN = not SPAWN_VFORK and getattr(subprocess, '_USE_POSIX_SPAWN', False)
+
+
+class OutputBuffer(object):
+    """collects child output, policy 'all' keeps everything, 'headtail' keeps the first and the last
+    `limit` bytes, 'spill' moves to a temporary file past `limit` bytes and getvalue() returns that file"""
+
+    def __init__(self, policy='all', limit=1024*1024):
+        if policy not in ('all', 'headtail', 'spill'):
+            raise ValueError('unknown output policy %r' % policy)
+        self.policy = policy
+        self.limit = limit
+        self.head = []
+        self.size = 0
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.skipped = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=limit) if policy == 'spill' else None
+
+    def write(self, data):
+        if not data:
+            return
+        if self.file:
+            self.file.write(data)
+            return
+        if self.policy == 'headtail' and self.size + len(data) > self.limit:
+            room = self.limit - self.size
+            if room > 0:
+                self.head.append(data[:room])
+                self.size += room
+                data = data[room:]
+            # ring of the newest chunks, trimmed from the left to `limit` bytes
+            self.tail.append(data)
+            self.tail_size += len(data)
+            while self.tail_size - len(self.tail[0]) >= self.limit:
+                chunk = self.tail.popleft()
+                self.tail_size -= len(chunk)
+                self.skipped += len(chunk)
+            return
+        self.head.append(data)
+        self.size += len(data)
+
+    def getvalue(self):
+        if self.file:
+            self.file.seek(0)
+            return self.file
+        data = b''.join(self.head)
+        if self.tail:
+            tail = b''.join(self.tail)
+            extra = len(tail) - self.limit
+            if extra > 0:
+                tail = tail[extra:]
+                self.skipped += extra
+                self.tail = collections.deque([tail])
+                self.tail_size = len(tail)
+            if self.skipped:
+                data += b'\n...[%d bytes skipped]...\n' % self.skipped
+            data += tail
+        return data
+
+
+class LineCallback(object):
+    """wraps a callback to be called once per complete line, flush() delivers a trailing partial line"""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.pending = []
+
+    def __call__(self, data):
+        pos = data.rfind(b'\n')
+        if pos < 0:
+            if data:
+                self.pending.append(data)
+            return
+        lines = b''.join(self.pending) + data[:pos]
+        self.pending = [data[pos+1:]] if pos + 1 < len(data) else []
+        for line in lines.split(b'\n'):
+            self.callback(line + b'\n')
+
+    def flush(self):
+        if self.pending:
+            self.callback(b''.join(self.pending))
+            self.pending = []
+
+
+def _popen(cmd, stdin, stderr, **subprocess_args):
+    """string commands run through /bin/sh, argv lists are spawned directly without a shell"""
+    if isinstance(cmd, (list, tuple)):
+        cmd = list(cmd)
+        if SPAWN_POSIX_SPAWN:
+            subprocess_args.setdefault('close_fds', False)
+            if os.sep not in cmd[0]:
+                import shutil
+                subprocess_args.setdefault('executable', shutil.which(cmd[0]) or cmd[0])
+        subprocess_args.setdefault('close_fds', os.name!='nt')
+        return subprocess.Popen(cmd, shell=False, stdin=stdin, stdout=subprocess.PIPE, stderr=stderr, **subprocess_args)
+    subprocess_args.setdefault('close_fds', os.name!='nt')
+    return subprocess.Popen(cmd, shell=True, stdin=stdin, stdout=subprocess.PIPE, stderr=stderr, **subprocess_args)
+
+
+def _drain(fileobj):
+    try:
+        return fileobj.read() or b''
+    except IOError as e:
+        if e.errno != errno.EAGAIN:
+            raise
+        return b''
+
+
+def getstatusoutput(cmd, input='', callback=None, timeout=86400*2, output_policy='all', output_limit=1024*1024, line_callback=False, merge_stderr=True, **subprocess_args):
+    """getstatusoutput implemented by subprocess, works with gevent/eventlet. Author: @phuslu, LICENSE: public domain
+
+    cmd is a shell command line, or an argv list which is spawned directly without /bin/sh.
+    output_policy/output_limit bound the buffered output, see OutputBuffer. line_callback=True hands
+    whole lines to callback. merge_stderr=False keeps stderr apart and returns (status, output, errors).
+    """
+    # no timeout still reads through the loop below, so output_policy bounds the memory used
+    timeout_at = time.time() + timeout if timeout else float('inf')
     interval = 0.1
     bat = ''
-    if os.name == 'nt' and len(cmd) >= (8000 if sys.getwindowsversion() >= (5, 1) else 2000):
+    if os.name == 'nt' and not isinstance(cmd, (list, tuple)) and len(cmd) >= (8000 if sys.getwindowsversion() >= (5, 1) else 2000):
         # http://support.microsoft.com/kb/830473
         try:
             bat = tempfile.mktemp(prefix='getstatusoutput_', suffix='.bat')
@@ -23,8 +153,18 @@ def getstatusoutput(cmd, input='', callback=None, timeout=86400*2, **subprocess_
                 fp.write('%s\r\n' % cmd)
         except OSError as e:
             logging.exception('mktemp %r error: %r', bat, e)
-            return 0x7f, str(e)
-    pipe = subprocess.Popen(bat or cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=os.name!='nt', **subprocess_args)
+            return (0x7f, str(e)) if merge_stderr else (0x7f, str(e), b'')
+    output = OutputBuffer(output_policy, output_limit)
+    errors = OutputBuffer(output_policy, output_limit)
+    result = lambda status, value: (status, value) if merge_stderr else (status, value, errors.getvalue())
+    if callable(callback) and line_callback:
+        callback = LineCallback(callback)
+    try:
+        pipe = _popen(bat or cmd, subprocess.PIPE if input else STDIN_NULL, subprocess.STDOUT if merge_stderr else subprocess.PIPE, **subprocess_args)
+    except OSError as e:
+        # argv commands have no shell to report a missing program
+        logging.error('subprocess cmd=%r failed: %r', cmd, e)
+        return result(0x7f, str(e))
     if input:
         try:
             pipe.stdin.write(input)
@@ -32,68 +172,237 @@ def getstatusoutput(cmd, input='', callback=None, timeout=86400*2, **subprocess_
             if e.errno != errno.EPIPE and e.errno != errno.EINVAL:
                 raise
         pipe.stdin.close()
-    if timeout:
-        try:
-            pipe_fd = pipe.stdout.fileno()
+    streams = [(pipe.stdout, callback if callable(callback) else output.write)]
+    if not merge_stderr:
+        streams.append((pipe.stderr, errors.write))
+    try:
+        handles = []
+        eof = set()
+        for fileobj, _ in streams:
+            pipe_fd = fileobj.fileno()
             if os.name == 'nt':
                 import msvcrt
                 pipe_fd = msvcrt.get_osfhandle(pipe_fd)
             else:
                 import fcntl
                 fcntl.fcntl(pipe_fd, fcntl.F_SETFL, os.O_NONBLOCK | fcntl.fcntl(pipe_fd, fcntl.F_GETFL))
-            output = b''
-            while time.time() < timeout_at:
-                if pipe.poll() is not None:
-                    output += pipe.stdout.read()
+            handles.append(pipe_fd)
+        while time.time() < timeout_at:
+            if pipe.poll() is not None:
+                for fileobj, write in streams:
+                    write(_drain(fileobj))
+                    fileobj.close()
+                if isinstance(callback, LineCallback):
+                    callback.flush()
+                if pipe.stdin:
                     pipe.stdin.close()
-                    pipe.stdout.close()
-                    return pipe.returncode, output
-                else:
-                    data = ''
-                    if os.name == 'nt':
-                        import ctypes.wintypes
-                        c_avail = ctypes.wintypes.DWORD()
+                return result(pipe.returncode, output.getvalue())
+            else:
+                if os.name == 'nt':
+                    import ctypes.wintypes
+                    c_avail = ctypes.wintypes.DWORD()
+                    ready = []
+                    for pipe_fd in handles:
                         ctypes.windll.kernel32.PeekNamedPipe(pipe_fd, None, 0, None, ctypes.byref(c_avail), None)
-                        if c_avail.value:
-                            data = pipe.stdout.read(min(c_avail.value, 1024))
-                        else:
-                            time.sleep(interval)
-                            interval = min(interval+0.1, 1)
+                        ready.append(c_avail.value)
+                    if not any(ready):
+                        time.sleep(interval)
+                        interval = min(interval+0.1, 1)
+                    for (fileobj, write), avail in zip(streams, ready):
+                        write(fileobj.read(min(avail, READ_SIZE)) if avail else b'')
+                elif len(eof) == len(handles):
+                    # all pipes are closed, only the exit status is missing
+                    if hasattr(subprocess, 'TimeoutExpired'):
+                        try:
+                            pipe.wait(max(min(timeout_at - time.time(), 1), 0))
+                        except subprocess.TimeoutExpired:
+                            pass
                     else:
-                        rlist, _, _ = select.select([pipe_fd], [], [], 1)
-                        if rlist:
+                        time.sleep(0.001)
+                else:
+                    rlist, _, _ = select.select([x for x in handles if x not in eof], [], [], 1)
+                    for (fileobj, write), pipe_fd in zip(streams, handles):
+                        data = b''
+                        if pipe_fd in rlist:
                             try:
-                                data = pipe.stdout.read(1024)
+                                data = fileobj.read(READ_SIZE)
+                                if data == b'':
+                                    eof.add(pipe_fd)
                             except IOError as e:
-                                if e[0] != errno.EAGAIN:
+                                if e.errno != errno.EAGAIN:
                                     raise
-                                sys.exc_clear()
-                    if callable(callback):
-                        callback(data)
-                    else:
-                        output += data
+                        write(data or b'')
+        if pipe.stdin:
             pipe.stdin.close()
-            pipe.stdout.close()
+        for fileobj, _ in streams:
+            fileobj.close()
+        try:
+            pipe.kill()
+            pipe.wait()
+        except OSError as e:
+            logging.error('kill pipe=%r pid=%r failed: %r', pipe, pipe.pid, e)
+        return result(0x7f, 'timed out')
+    except Exception as e:
+        logging.exception('subporcess cmd=%r poll failed: %r', cmd, e)
+        return result(0x7f, str(e))
+    finally:
+        if bat and os.path.isfile(bat):
+            try:
+                os.remove(bat)
+            except OSError as e:
+                logging.error('os.remove(%r) failed: %r', bat, e)
+
+
+def getstatusoutput_many(cmds, concurrency=16, callback=None, timeout=86400*2, output_policy='all', output_limit=1024*1024, **subprocess_args):
+    """run many commands under one selectors loop, yields (index, status, output) as each child finishes.
+
+    every child gets its own timeout, callback(index, data) receives output chunks instead of buffering them.
+    """
+    if selectors is None or os.name == 'nt':
+        for index, cmd in enumerate(cmds):
+            status, output = getstatusoutput(cmd, callback=(lambda data, index=index: callback(index, data)) if callable(callback) else None, timeout=timeout, output_policy=output_policy, output_limit=output_limit, **subprocess_args)
+            yield index, status, output
+        return
+    import fcntl
+    cmds = list(enumerate(cmds))
+    cmds.reverse()
+    selector = selectors.DefaultSelector()
+    running = {}
+    # children whose pipe hit eof but which have not exited yet, index -> (child, pidfd or None)
+    exiting = {}
+
+    def release(child, drain=False):
+        index, pipe, output, _ = child
+        fd = pipe.stdout.fileno()
+        selector.unregister(fd)
+        del running[fd]
+        while drain:
+            # the child may exit while a grandchild still holds the pipe, drain what is there
+            try:
+                data = os.read(fd, READ_SIZE)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                data = b''
+            if not data:
+                break
+            if callable(callback):
+                callback(index, data)
+            else:
+                output.write(data)
+        pipe.stdout.close()
+
+    def wait_exit(child):
+        """a child which closed its output may still run, its exit is picked up by the loop instead of a blocking wait"""
+        pidfd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(child[1].pid)
+                selector.register(pidfd, selectors.EVENT_READ, child)
+            except OSError:
+                pidfd = None
+        exiting[child[0]] = (child, pidfd)
+
+    def finish(child, status=None):
+        index, pipe, output, _ = child
+        if child[0] in exiting:
+            pidfd = exiting.pop(child[0])[1]
+            if pidfd is not None:
+                selector.unregister(pidfd)
+                os.close(pidfd)
+        elif not pipe.stdout.closed:
+            release(child, drain=status is None)
+        if status is None:
+            status = pipe.wait()
+            output = output.getvalue()
+        else:
             try:
                 pipe.kill()
                 pipe.wait()
             except OSError as e:
                 logging.error('kill pipe=%r pid=%r failed: %r', pipe, pipe.pid, e)
-            return 0x7f, 'timed out'
-        except Exception as e:
-            logging.exception('subporcess cmd=%r poll failed: %r', cmd, e)
-            return 0x7f, str(e)
-        finally:
-            if bat and os.path.isfile(bat):
+            output = 'timed out'
+        return index, status, output
+
+    try:
+        while cmds or running or exiting:
+            while cmds and len(running) + len(exiting) < concurrency:
+                index, cmd = cmds.pop()
                 try:
-                    os.remove(bat)
+                    pipe = _popen(cmd, STDIN_NULL, subprocess.STDOUT, **subprocess_args)
                 except OSError as e:
-                    logging.error('os.remove(%r) failed: %r', bat, e)
-    else:
-        pipe.wait()
-        return pipe.returncode, pipe.stdout.read()
+                    logging.error('subprocess cmd=%r failed: %r', cmd, e)
+                    yield index, 0x7f, str(e)
+                    continue
+                if pipe.stdin:
+                    pipe.stdin.close()
+                fd = pipe.stdout.fileno()
+                fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK | fcntl.fcntl(fd, fcntl.F_GETFL))
+                running[fd] = (index, pipe, OutputBuffer(output_policy, output_limit), time.time() + timeout)
+                selector.register(fd, selectors.EVENT_READ)
+            if not running and not exiting:
+                continue
+            children = list(running.values()) + [x[0] for x in exiting.values()]
+            now = time.time()
+            # wake up at least once a second to notice children which exited with the pipe held open,
+            # and often while an exiting child has no pidfd to wake the loop
+            wait = max(min(min(x[3] for x in children) - now, 1), 0)
+            if any(x[1] is None for x in exiting.values()):
+                wait = min(wait, 0.01)
+            for key, _ in selector.select(wait):
+                if key.data is not None:
+                    # a pidfd, that child has exited
+                    child = key.data
+                    if child[1].poll() is not None:
+                        yield finish(child)
+                    continue
+                child = running[key.fd]
+                try:
+                    data = os.read(key.fd, READ_SIZE)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    continue
+                if not data:
+                    release(child)
+                    if child[1].poll() is not None:
+                        yield finish(child)
+                    else:
+                        wait_exit(child)
+                elif callable(callback):
+                    callback(child[0], data)
+                else:
+                    child[2].write(data)
+            now = time.time()
+            for child in list(running.values()) + [x[0] for x in exiting.values()]:
+                if child[3] <= now:
+                    yield finish(child, 0x7f)
+                elif child[1].poll() is not None:
+                    yield finish(child)
+    finally:
+        for child in list(running.values()) + [x[0] for x in exiting.values()]:
+            finish(child, 0x7f)
+        selector.close()
+
+
+def bench_spawn(count=1000):
+    """spawns per second of /bin/true through /bin/sh and as a direct argv"""
+    for name, cmd in (('shell', '/bin/true'), ('direct', ['/bin/true'])):
+        start = time.time()
+        for _ in range(count):
+            getstatusoutput(cmd)
+        elapsed = time.time() - start
+        print('%-6s %d spawns in %.2fs, %.0f spawns/s' % (name, count, elapsed, count / elapsed))
+    start = time.time()
+    for _ in getstatusoutput_many([['/bin/true']] * count, concurrency=32):
+        pass
+    elapsed = time.time() - start
+    print('%-6s %d spawns in %.2fs, %.0f spawns/s' % ('many', count, elapsed, count / elapsed))
 
 
 if __name__ == '__main__':
-    print(getstatusoutput('ver 2>/dev/null || uname -a'))
+    if sys.argv[1:] == ['bench']:
+        bench_spawn()
+    else:
+        print(getstatusoutput('ver 2>/dev/null || uname -a'))
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+import sys
+import os
+import time
+import logging
+import signal
+import asyncio
+import tempfile
+import threading
+
+READ_SIZE = 65536
+
+
+async def getstatusoutput_async(cmd, input='', callback=None, timeout=86400*2, **subprocess_args):
+    """asyncio counterpart of getstatusoutput, kills the child on timeout or task cancellation"""
+    bat = ''
+    if os.name == 'nt' and len(cmd) >= (8000 if sys.getwindowsversion() >= (5, 1) else 2000):
+        # http://support.microsoft.com/kb/830473
+        try:
+            bat = tempfile.mktemp(prefix='getstatusoutput_', suffix='.bat')
+            with open(bat, 'wb') as fp:
+                fp.write(('%s\r\n' % cmd).encode())
+        except OSError as e:
+            logging.exception('mktemp %r error: %r', bat, e)
+            return 0x7f, str(e)
+    if os.name != 'nt':
+        # own process group, so a kill also reaches what /bin/sh forked and nothing holds the pipe open
+        subprocess_args.setdefault('start_new_session', True)
+    try:
+        pipe = await asyncio.create_subprocess_shell(bat or cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, close_fds=os.name!='nt', **subprocess_args)
+        try:
+            # a falsy timeout is no timeout, as in getstatusoutput
+            return await asyncio.wait_for(_communicate(pipe, input, callback), timeout or None)
+        except asyncio.TimeoutError:
+            return 0x7f, 'timed out'
+        finally:
+            if pipe.returncode is None:
+                try:
+                    if subprocess_args.get('start_new_session'):
+                        os.killpg(pipe.pid, signal.SIGKILL)
+                    else:
+                        pipe.kill()
+                except OSError as e:
+                    logging.error('kill pipe=%r pid=%r failed: %r', pipe, pipe.pid, e)
+                # shielded, so a cancelled task still reaps its child
+                await asyncio.shield(pipe.wait())
+    except (OSError, ValueError) as e:
+        logging.exception('subporcess cmd=%r poll failed: %r', cmd, e)
+        return 0x7f, str(e)
+    finally:
+        if bat and os.path.isfile(bat):
+            try:
+                os.remove(bat)
+            except OSError as e:
+                logging.error('os.remove(%r) failed: %r', bat, e)
+
+
+async def _communicate(pipe, input, callback):
+    if input:
+        try:
+            pipe.stdin.write(input.encode() if isinstance(input, str) else input)
+            await pipe.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    pipe.stdin.close()
+    chunks = []
+    while True:
+        data = await pipe.stdout.read(READ_SIZE)
+        if not data:
+            break
+        if callable(callback):
+            callback(data)
+        else:
+            chunks.append(data)
+    await pipe.wait()
+    return pipe.returncode, b''.join(chunks)
+
+
+def _test(count=500):
+    # before 3.12 the default child watcher starts a thread per child, pidfd needs none
+    if sys.version_info < (3, 12) and hasattr(asyncio, 'PidfdChildWatcher'):
+        watcher = asyncio.PidfdChildWatcher()
+        asyncio.set_child_watcher(watcher)
+    threads = []
+
+    async def main():
+        start = time.time()
+        tasks = [getstatusoutput_async('sleep 1; echo %d' % i) for i in range(count)]
+        tasks.append(getstatusoutput_async('sleep 10', timeout=1.5))
+        sleeper = asyncio.ensure_future(getstatusoutput_async('sleep 10'))
+        await asyncio.sleep(0.5)
+        threads.append(threading.active_count())
+        sleeper.cancel()
+        results = await asyncio.gather(*tasks)
+        assert all(r == (0, b'%d\n' % i) for i, r in enumerate(results[:count])), results
+        assert results[-1] == (0x7f, 'timed out'), results[-1]
+        try:
+            await sleeper
+        except asyncio.CancelledError:
+            pass
+        return time.time() - start
+
+    elapsed = asyncio.run(main())
+    print('%d concurrent commands finished in %.2fs with %d thread(s)' % (count, elapsed, threads[0]))
+    assert threads[0] == 1
+
+
+if __name__ == '__main__':
+    print(asyncio.run(getstatusoutput_async('ver 2>/dev/null || uname -a')))
+    _test()
@@ -6,21 +6,1374 @@ usage: python httpsserver.py 443
 """
 
 import sys
+import os
+import io
+import re
 import ssl
-import SocketServer
-import BaseHTTPServer
-import SimpleHTTPServer
+import json
+import stat
+import bisect
+import time
+import socket
+import signal
+import logging
+import argparse
+import threading
+import collections
+import email.utils
+
+PY3 = sys.version >= '3'
+if PY3:
+    import socketserver as SocketServer
+    import http.server as BaseHTTPServer
+    import http.server as SimpleHTTPServer
+    import queue as Queue
+    from html import escape
+    from urllib.parse import quote, unquote, parse_qs
+    import selectors
+    import http.client
+    import concurrent.futures
+else:
+    import SocketServer
+    import BaseHTTPServer
+    import SimpleHTTPServer
+    import Queue
+    from cgi import escape
+    from urllib import quote, unquote
+    from urlparse import parse_qs
+    # the event loop engine needs selectors and concurrent.futures
+    selectors = None
 
 # openssl req -new -x509 -days 365 -nodes -out cert.pem -keyout cert.pem
 CERT_FILE = './cert.pem'
+HANDSHAKE_TIMEOUT = 10
+# seconds a stopping process waits for in-flight requests
+GRACEFUL_TIMEOUT = 10
+# chunk of the memoryview copy loop used where sendfile can not be, e.g. over TLS
+COPY_CHUNK_SIZE = 256 * 1024
+# precompressed sidecars tried in order, like nginx gzip_static/brotli_static
+SIDECARS = (('br', '.br'), ('gzip', '.gz'))
+# event loop engine: keep-alive idle timeout, file i/o threads and per-connection read-ahead bound
+IDLE_TIMEOUT = 75
+IO_THREADS = 8
+MAX_REQUEST_BUFFER = 64 * 1024
+# hot-file cache: byte budget, files above CACHE_MAX_FILE_SIZE bypass it, entries are re-stat'ed at most every CACHE_CHECK_INTERVAL
+CACHE_SIZE = 64 * 1024 * 1024
+CACHE_MAX_FILE_SIZE = 1024 * 1024
+CACHE_CHECK_INTERVAL = 1
+# directory listings: directories kept, entries per page, and a rescan age for in-place file changes the dir mtime misses
+LISTING_CACHE_DIRS = 256
+LISTING_PAGE_SIZE = 1000
+LISTING_MAX_AGE = 60
+LISTING_CACHE_PAGES = 16
+# metrics endpoint (answered to loopback clients only) and the access log writer
+METRICS_PATH = '/.metrics'
+METRICS_MAX_PREFIXES = 64
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+ACCESS_LOG_FLUSH_INTERVAL = 1
+ACCESS_LOG_BATCH = 256
+ACCESS_LOG_MAX_PENDING = 100000
+
+
+class CertContext(object):
+    """one SSLContext shared by all connections, reloaded when the cert file changes"""
+
+    def __init__(self, certfile, keyfile=None, check_interval=1):
+        self.certfile = certfile
+        self.keyfile = keyfile or certfile
+        self.check_interval = check_interval
+        self.checked_at = time.time()
+        self.mtime = os.stat(certfile).st_mtime
+        self.lock = threading.Lock()
+        self.context = self.load()
+
+    def load(self):
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        context.options |= getattr(ssl, 'OP_NO_SSLv2', 0) | getattr(ssl, 'OP_NO_SSLv3', 0)
+        # session tickets and the OpenSSL server session cache give clients abbreviated handshakes
+        context.options &= ~getattr(ssl, 'OP_NO_TICKET', 0)
+        context.load_cert_chain(self.certfile, self.keyfile)
+        return context
+
+    def get(self):
+        now = time.time()
+        if now - self.checked_at >= self.check_interval:
+            with self.lock:
+                if now - self.checked_at >= self.check_interval:
+                    self.checked_at = now
+                    try:
+                        mtime = os.stat(self.certfile).st_mtime
+                        if mtime != self.mtime:
+                            self.context = self.load()
+                            self.mtime = mtime
+                            logging.info('reloaded certificate %r', self.certfile)
+                    except (OSError, IOError, ssl.SSLError) as e:
+                        logging.error('reload certificate %r failed: %r', self.certfile, e)
+        return self.context
+
+
+class StaticFile(object):
+    """a resolved static file response, the body is `data` when it came from the FileCache, else `file`"""
+
+    def __init__(self, status, headers, file=None, offset=0, length=0, data=None):
+        self.status = status
+        self.headers = headers
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.data = data
+
+
+def _accepts_encoding(accept_encoding, coding):
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        if name.strip().lower() == coding:
+            m = re.search(r'q=([\d.]+)', params)
+            return not m or float(m.group(1)) > 0
+    return False
+
+
+def _parse_range(value, size):
+    """(start, end) of a single "bytes=" range, None to ignore it, False when unsatisfiable"""
+    m = re.match(r'^bytes=(\d*)-(\d*)$', value.strip())
+    if not m or not any(m.groups()):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+        if start >= size or end < start:
+            return False
+    else:
+        suffix = int(m.group(2))
+        if suffix == 0 or size == 0:
+            return False
+        start, end = max(size - suffix, 0), size - 1
+    return start, end
+
+
+class CachedFile(object):
+    """bytes and pre-built headers of a small file and its sidecars, keyed by encoding (None is the file itself)"""
+
+    def __init__(self, ctype, variants, sidecars, checked_at):
+        self.ctype = ctype
+        # encoding -> (path, data, mtime, etag, last_modified, validators, headers of a 200)
+        self.variants = variants
+        self.sidecars = sidecars
+        self.checked_at = checked_at
+        self.size = sum(len(x[1]) for x in variants.values())
+
+
+class FileCache(object):
+    """LRU of small files with a byte budget, entries are checked against mtime/size at most every check_interval"""
+
+    def __init__(self, budget=CACHE_SIZE, max_file_size=CACHE_MAX_FILE_SIZE, check_interval=CACHE_CHECK_INTERVAL):
+        self.budget = budget
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = self.misses = self.bypasses = self.evictions = self.invalidations = 0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size, 'budget': self.budget,
+                'hits': self.hits, 'misses': self.misses, 'bypasses': self.bypasses,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
+
+    def get(self, path, ctype):
+        """the CachedFile of path, loaded on a miss, None when the file is too large or unreadable"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and now - entry.checked_at < self.check_interval:
+                self.entries[path] = self.entries.pop(path)
+                self.hits += 1
+                return entry
+        if entry:
+            if self.fresh(path, entry):
+                entry.checked_at = now
+                with self.lock:
+                    self.hits += 1
+                return entry
+            with self.lock:
+                if self.remove(path, entry):
+                    self.invalidations += 1
+        entry = self.load(path, ctype, now)
+        with self.lock:
+            if entry is None:
+                self.bypasses += 1
+                return None
+            self.misses += 1
+            if path not in self.entries:
+                self.entries[path] = entry
+                self.size += entry.size
+                while self.size > self.budget:
+                    self.size -= self.entries.popitem(last=False)[1].size
+                    self.evictions += 1
+        return entry
+
+    def remove(self, path, entry):
+        # called with the lock held, another thread may have dropped or replaced entry already
+        if self.entries.get(path) is not entry:
+            return False
+        del self.entries[path]
+        self.size -= entry.size
+        return True
+
+    def fresh(self, path, entry):
+        for coding, suffix in SIDECARS:
+            if (coding in entry.variants) != os.path.isfile(path + suffix):
+                return False
+        for variant in entry.variants.values():
+            try:
+                st = os.stat(variant[0])
+            except OSError:
+                return False
+            if st.st_mtime != variant[2] or st.st_size != len(variant[1]):
+                return False
+        return True
+
+    def load(self, path, ctype, now):
+        sidecars = [(coding, path + suffix) for coding, suffix in SIDECARS if os.path.isfile(path + suffix)]
+        variants = {}
+        for coding, variant_path in [(None, path)] + sidecars:
+            try:
+                with open(variant_path, 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    if st.st_size > self.max_file_size:
+                        return None
+                    data = f.read()
+            except (IOError, OSError):
+                return None
+            if len(data) != st.st_size:
+                # being written right now
+                return None
+            etag, last_modified, validators = _validators(st.st_mtime, st.st_size, coding, bool(sidecars))
+            headers = _entity_headers(ctype, coding, validators) + [('Content-Length', str(len(data)))]
+            variants[coding] = (variant_path, data, st.st_mtime, etag, last_modified, validators, headers)
+        if sum(len(x[1]) for x in variants.values()) > self.budget:
+            return None
+        return CachedFile(ctype, variants, [coding for coding, _ in sidecars], now)
+
+
+class Histogram(object):
+    """fixed-bucket histogram, counts[i] is the number of values <= buckets[i], the last one is +Inf"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def prometheus(self, name, lines):
+        lines.append('# TYPE %s histogram' % name)
+        total = 0
+        for bucket, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('%s_bucket{le="%s"} %d' % (name, bucket, total))
+        lines.append('%s_sum %s' % (name, self.sum))
+        lines.append('%s_count %d' % (name, self.count))
+
+    def json(self):
+        return {'buckets': list(self.buckets), 'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+
+class Metrics(object):
+    """request counts per status and path prefix, bytes sent, handshake/ttfb/response size histograms
+
+    every process counts on its own, under --workers a scrape sees the worker which accepted it.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.sent_bytes = 0
+        self.handshake = Histogram(LATENCY_BUCKETS)
+        self.ttfb = Histogram(LATENCY_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+
+    def observe_handshake(self, seconds):
+        with self.lock:
+            self.handshake.observe(seconds)
+
+    def observe_request(self, status, path, ttfb, sent):
+        # first path segment, so /soft/ and /topic/ are told apart without a label per file
+        prefix = path.partition('?')[0]
+        prefix = prefix[:prefix.find('/', 1) + 1] or '/'
+        with self.lock:
+            if (status, prefix) not in self.requests and len(self.requests) >= METRICS_MAX_PREFIXES:
+                prefix = 'other'
+            self.requests[status, prefix] = self.requests.get((status, prefix), 0) + 1
+            self.sent_bytes += sent
+            if ttfb is not None:
+                self.ttfb.observe(ttfb)
+            self.response_bytes.observe(sent)
+
+    def caches(self):
+        stats = {'listing_cache': {'hits': self.server.listing_cache.hits, 'misses': self.server.listing_cache.misses}}
+        if self.server.file_cache:
+            stats['file_cache'] = self.server.file_cache.stats()
+        if self.server.access_log:
+            stats['access_log'] = {'dropped': self.server.access_log.dropped}
+        return stats
+
+    def prometheus(self):
+        with self.lock:
+            lines = ['# TYPE httpsserver_start_time_seconds gauge', 'httpsserver_start_time_seconds %f' % self.started_at,
+                     '# TYPE httpsserver_requests_total counter']
+            for (status, prefix), count in sorted(self.requests.items()):
+                lines.append('httpsserver_requests_total{status="%s",prefix="%s"} %d' % (status, prefix.replace('\\', '\\\\').replace('"', '\\"'), count))
+            lines += ['# TYPE httpsserver_sent_bytes_total counter', 'httpsserver_sent_bytes_total %d' % self.sent_bytes]
+            self.handshake.prometheus('httpsserver_tls_handshake_seconds', lines)
+            self.ttfb.prometheus('httpsserver_ttfb_seconds', lines)
+            self.response_bytes.prometheus('httpsserver_response_bytes', lines)
+        for cache, stats in sorted(self.caches().items()):
+            for key, value in sorted(stats.items()):
+                if key not in ('entries', 'bytes', 'budget'):
+                    lines.append('httpsserver_%s_%s_total %d' % (cache, key, value))
+        return ('\n'.join(lines) + '\n').encode()
+
+    def json(self):
+        with self.lock:
+            data = {
+                'start_time': self.started_at,
+                'requests': [dict(status=status, prefix=prefix, count=count) for (status, prefix), count in sorted(self.requests.items())],
+                'sent_bytes': self.sent_bytes,
+                'tls_handshake_seconds': self.handshake.json(),
+                'ttfb_seconds': self.ttfb.json(),
+                'response_bytes': self.response_bytes.json(),
+            }
+        data.update(self.caches())
+        return json.dumps(data).encode()
+
+
+class AccessLog(object):
+    """access log lines are queued and written by one thread in batches, requests never wait on the stream"""
+
+    def __init__(self, stream, flush_interval=ACCESS_LOG_FLUSH_INTERVAL, batch=ACCESS_LOG_BATCH, max_pending=ACCESS_LOG_MAX_PENDING):
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.batch = batch
+        self.max_pending = max_pending
+        self.lines = collections.deque()
+        self.dropped = 0
+        self.wakeup = threading.Event()
+        self.flush_lock = threading.Lock()
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def write(self, line):
+        if len(self.lines) >= self.max_pending:
+            # a stalled stream must not grow the queue without bound
+            self.dropped += 1
+            return
+        self.lines.append(line)
+        if len(self.lines) >= self.batch:
+            self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            batch = []
+            while self.lines:
+                batch.append(self.lines.popleft())
+            if not batch:
+                return
+            try:
+                self.stream.write(''.join(batch))
+                self.stream.flush()
+            except (IOError, OSError, ValueError) as e:
+                self.dropped += len(batch)
+                logging.error('access log write failed: %r', e)
+
+
+class _CountingWriter(object):
+    """file-like wrapper counting the bytes written through it"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.wfile.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
+
+
+class DirListing(object):
+    """sorted (name, is_dir, size, mtime) of one directory and the pages rendered from it"""
+
+    def __init__(self, mtime, entries, built_at):
+        self.mtime = mtime
+        self.entries = entries
+        self.built_at = built_at
+        # (format, page) -> (body, next page), the LISTING_CACHE_PAGES most recently used
+        self.pages = collections.OrderedDict()
+
+
+class ListingCache(object):
+    """LRU of directory listings, rescanned when the directory mtime changes or the listing is max_age old"""
+
+    def __init__(self, max_dirs=LISTING_CACHE_DIRS, max_age=LISTING_MAX_AGE):
+        self.max_dirs = max_dirs
+        self.max_age = max_age
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, path):
+        mtime = os.stat(path).st_mtime
+        now = time.time()
+        with self.lock:
+            listing = self.entries.pop(path, None)
+            if listing and listing.mtime == mtime and now - listing.built_at < self.max_age:
+                self.entries[path] = listing
+                self.hits += 1
+                return listing
+        listing = DirListing(mtime, _scan_dir(path), now)
+        with self.lock:
+            self.misses += 1
+            self.entries[path] = listing
+            while len(self.entries) > self.max_dirs:
+                self.entries.popitem(last=False)
+        return listing
+
+
+def _scan_dir(path):
+    """directories first then names, like nginx autoindex; entries which can not be stat'ed are left out"""
+    entries = []
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((entry.name, stat.S_ISDIR(st.st_mode), st.st_size, st.st_mtime))
+    else:
+        for name in os.listdir(path):
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            entries.append((name, stat.S_ISDIR(st.st_mode), st.st_size, st.st_mtime))
+    entries.sort(key=lambda x: (not x[1], x[0].lower()))
+    return entries
+
+
+def _validators(mtime, size, encoding, vary):
+    etag = '"%x-%x%s"' % (int(mtime), size, '-' + encoding if encoding else '')
+    last_modified = email.utils.formatdate(mtime, usegmt=True)
+    validators = [('ETag', etag), ('Last-Modified', last_modified)]
+    if vary:
+        validators.append(('Vary', 'Accept-Encoding'))
+    return etag, last_modified, validators
+
+
+def _entity_headers(ctype, encoding, validators):
+    headers = [('Content-Type', ctype), ('Accept-Ranges', 'bytes')] + validators
+    if encoding:
+        headers.append(('Content-Encoding', encoding))
+    return headers
+
+
+def open_static(path, headers, ctype, cache=None):
+    """resolve a GET/HEAD of a regular file, handles conditional requests, byte ranges and .br/.gz sidecars
+
+    small files are served from `cache` (a FileCache) when given, without a syscall on a fresh hit.
+    """
+    entry = cache.get(path, ctype) if cache else None
+    if entry:
+        sidecars = entry.sidecars
+    else:
+        sidecars = [coding for coding, suffix in SIDECARS if os.path.isfile(path + suffix)]
+    encoding = None
+    accept_encoding = headers.get('Accept-Encoding', '')
+    for coding in sidecars:
+        if _accepts_encoding(accept_encoding, coding):
+            encoding = coding
+            break
+    f = data = None
+    if entry:
+        _, data, mtime, etag, last_modified, validators, headers_200 = entry.variants[encoding]
+        size = len(data)
+    else:
+        f = open(path + dict(SIDECARS)[encoding] if encoding else path, 'rb')
+    try:
+        if f:
+            st = os.fstat(f.fileno())
+            mtime, size = st.st_mtime, st.st_size
+            etag, last_modified, validators = _validators(mtime, size, encoding, bool(sidecars))
+        not_modified = False
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match:
+            not_modified = if_none_match.strip() == '*' or etag in [x.strip() for x in if_none_match.split(',')]
+        elif headers.get('If-Modified-Since'):
+            since = email.utils.parsedate_tz(headers['If-Modified-Since'])
+            not_modified = bool(since) and int(mtime) <= email.utils.mktime_tz(since)
+        if not_modified:
+            if f:
+                f.close()
+            return StaticFile(304, validators)
+        byte_range = None
+        if headers.get('Range') and headers.get('If-Range', etag) in (etag, last_modified):
+            byte_range = _parse_range(headers['Range'], size)
+        if byte_range is False:
+            if f:
+                f.close()
+            return StaticFile(416, [('Content-Range', 'bytes */%d' % size), ('Content-Length', '0')])
+        if byte_range:
+            start, end = byte_range
+            headers_out = _entity_headers(ctype, encoding, validators)
+            headers_out += [('Content-Range', 'bytes %d-%d/%d' % (start, end, size)), ('Content-Length', str(end - start + 1))]
+            if data is not None:
+                return StaticFile(206, headers_out, data=data[start:end + 1])
+            return StaticFile(206, headers_out, f, start, end - start + 1)
+        if data is not None:
+            return StaticFile(200, headers_200, data=data)
+        headers_out = _entity_headers(ctype, encoding, validators) + [('Content-Length', str(size))]
+        return StaticFile(200, headers_out, f, 0, size)
+    except:
+        if f:
+            f.close()
+        raise
+
+
+class HTTPSRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """SimpleHTTPRequestHandler with sendfile, ranges, conditional GET and precompressed sidecars"""
+
+    body_range = None
+    status = None
+    request_started = None
+    ttfb = None
+    sent_extra = 0
+
+    def setup(self):
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+        if self.server.metrics:
+            self.wfile = _CountingWriter(self.wfile)
+
+    def handle_one_request(self):
+        metrics = self.server.metrics
+        if not metrics:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.handle_one_request(self)
+        self.status = self.request_started = self.ttfb = None
+        self.sent_extra = 0
+        # parse_request may send a 400 before it sets path, and a keep-alive connection still has the last one
+        self.path = '-'
+        sent = self.wfile.count
+        SimpleHTTPServer.SimpleHTTPRequestHandler.handle_one_request(self)
+        if self.status is not None:
+            metrics.observe_request(self.status, self.path, self.ttfb, self.wfile.count - sent + self.sent_extra)
+
+    def parse_request(self):
+        self.request_started = time.time()
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.parse_request(self)
+
+    def send_response(self, code, message=None):
+        self.status = code
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_response(self, code, message)
+
+    def end_headers(self):
+        SimpleHTTPServer.SimpleHTTPRequestHandler.end_headers(self)
+        if self.ttfb is None and self.request_started:
+            self.ttfb = time.time() - self.request_started
+
+    def log_message(self, format, *args):
+        access_log = getattr(self.server, 'access_log', None)
+        if not access_log:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.log_message(self, format, *args)
+        access_log.write('%s - - [%s] %s\n' % (self.address_string(), self.log_date_time_string(), format % args))
+
+    def send_metrics(self, query):
+        metrics = self.server.metrics
+        if not metrics or not (self.client_address[0].startswith('127.') or self.client_address[0] in ('::1', '::ffff:127.0.0.1')):
+            self.send_error(404, 'File not found')
+            return None
+        fmt = parse_qs(query).get('format', ['prometheus'])[0]
+        body = metrics.json() if fmt == 'json' else metrics.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json' if fmt == 'json' else 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def send_head(self):
+        url_path, _, query = self.path.partition('?')
+        if self.server.metrics_path and url_path == self.server.metrics_path:
+            return self.send_metrics(query)
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            if not self.path.split('?', 1)[0].split('#', 1)[0].endswith('/'):
+                return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+            for index in ('index.html', 'index.htm'):
+                index = os.path.join(path, index)
+                if os.path.isfile(index):
+                    path = index
+                    break
+            else:
+                return self.list_directory(path)
+        if path.endswith('/'):
+            self.send_error(404, 'File not found')
+            return None
+        try:
+            static = open_static(path, self.headers, self.guess_type(path), getattr(self.server, 'file_cache', None))
+        except (IOError, OSError):
+            self.send_error(404, 'File not found')
+            return None
+        self.send_response(static.status)
+        for key, value in static.headers:
+            self.send_header(key, value)
+        self.end_headers()
+        if static.data is not None:
+            self.body_range = None
+            return io.BytesIO(static.data)
+        self.body_range = (static.offset, static.length)
+        return static.file
+
+    def list_directory(self, path):
+        """nginx autoindex style listing, paginated, cached per directory
+
+        ?format=json gives nginx autoindex_format json with exact sizes, pages are chained with a Link header.
+        when /autoindex.html exists it is appended to the html rows, like add_after_body in nginx.conf.
+        """
+        query = parse_qs(self.path.partition('?')[2].partition('#')[0])
+        fmt = query.get('format', ['html'])[0]
+        if fmt not in ('html', 'json'):
+            self.send_error(400, 'Unknown listing format')
+            return None
+        try:
+            page = max(int(query.get('page', ['1'])[0]), 1)
+            listing = self.server.listing_cache.get(path)
+        except (ValueError, OSError):
+            self.send_error(404, 'No permission to list directory')
+            return None
+        if page > 1 and (page - 1) * LISTING_PAGE_SIZE >= len(listing.entries):
+            self.send_error(404, 'No such page')
+            return None
+        autoindex = self.translate_path('/autoindex.html') if fmt != 'json' else ''
+        if not os.path.isfile(autoindex):
+            autoindex = ''
+        key = (fmt, page)
+        lock = self.server.listing_cache.lock
+        with lock:
+            rendered = listing.pages.pop(key, None)
+            if rendered is not None:
+                listing.pages[key] = rendered
+        if rendered is None:
+            rendered = self.render_listing(listing.entries, fmt, page)
+            with lock:
+                listing.pages[key] = rendered
+                while len(listing.pages) > LISTING_CACHE_PAGES:
+                    listing.pages.popitem(last=False)
+        body, next_page = rendered
+        if autoindex:
+            with open(autoindex, 'rb') as f:
+                body += f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json' if fmt == 'json' else 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if next_page:
+            self.send_header('Link', '<%s>; rel="next"' % next_page)
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def render_listing(self, entries, fmt, page):
+        start = (page - 1) * LISTING_PAGE_SIZE
+        rows = entries[start:start + LISTING_PAGE_SIZE]
+        next_page = '?%spage=%d' % ('format=json&' if fmt == 'json' else '', page + 1) if start + LISTING_PAGE_SIZE < len(entries) else ''
+        if fmt == 'json':
+            items = []
+            for name, is_dir, size, mtime in rows:
+                item = {'name': name, 'type': 'directory' if is_dir else 'file', 'mtime': email.utils.formatdate(mtime, usegmt=True)}
+                if not is_dir:
+                    item['size'] = size
+                items.append(item)
+            return json.dumps(items, separators=(',', ':')).encode(), next_page
+        title = 'Index of %s' % escape(unquote(self.path.partition('?')[0]))
+        lines = ['<html>', '<head><meta charset="utf-8"><title>%s</title></head>' % title, '<body>',
+                 '<h1>%s</h1><hr><pre><a href="../">../</a>' % title]
+        for name, is_dir, size, mtime in rows:
+            name += '/' if is_dir else ''
+            display = name if len(name) <= 50 else name[:47] + '..>'
+            lines.append('<a href="%s">%s</a>%s %s %19s' % (quote(name), escape(display), ' ' * (50 - len(display)),
+                         time.strftime('%d-%b-%Y %H:%M', time.localtime(mtime)), '-' if is_dir else size))
+        if next_page:
+            lines.append('<a href="%s">next page</a>' % next_page)
+        lines.append('</pre><hr>')
+        lines.append('</body>\n</html>\n')
+        return '\n'.join(lines).encode('utf-8', 'surrogateescape') if PY3 else '\n'.join(lines), next_page
+
+    def copyfile(self, source, outputfile):
+        if isinstance(source, io.BytesIO):
+            # cached files and listings are in memory already, one write
+            outputfile.write(source.getvalue())
+            return
+        if self.body_range is None:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+        offset, length = self.body_range
+        self.body_range = None
+        sock = self.connection
+        if hasattr(sock, 'sendfile') and not isinstance(sock, ssl.SSLSocket):
+            # plaintext, the kernel moves the bytes
+            self.sent_extra += sock.sendfile(source, offset, length)
+            return
+        source.seek(offset)
+        if not PY3:
+            while length > 0:
+                data = source.read(min(length, COPY_CHUNK_SIZE))
+                if not data:
+                    break
+                outputfile.write(data)
+                length -= len(data)
+            return
+        buf = memoryview(bytearray(COPY_CHUNK_SIZE))
+        while length > 0:
+            n = source.readinto(buf[:min(length, COPY_CHUNK_SIZE)])
+            if not n:
+                break
+            outputfile.write(buf[:n])
+            length -= n
+
 
 class ThreadingSimpleServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    certfile = CERT_FILE
+    handshake_timeout = HANDSHAKE_TIMEOUT
+    # SO_REUSEPORT lets every prefork worker own a listening socket on the same port
+    reuse_port = False
+    # 0 keeps a thread per connection, otherwise a fixed pool of threads takes connections from a queue
+    pool_size = 0
+    # byte budget of the hot-file cache, 0 disables it
+    cache_size = CACHE_SIZE
+    metrics_path = METRICS_PATH
+    access_log_stream = sys.stderr
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+        BaseHTTPServer.HTTPServer.server_bind(self)
+
+    def server_activate(self):
+        self.certs = CertContext(self.certfile) if self.certfile else None
+        self.file_cache = FileCache(self.cache_size) if self.cache_size else None
+        self.listing_cache = ListingCache()
+        self.access_log = AccessLog(self.access_log_stream) if self.access_log_stream else None
+        self.metrics = Metrics(self) if self.metrics_path else None
+        self.active = 0
+        self.active_lock = threading.Lock()
+        BaseHTTPServer.HTTPServer.server_activate(self)
+        if self.pool_size:
+            self.pending = Queue.Queue()
+            for _ in range(self.pool_size):
+                t = threading.Thread(target=self.pool_worker)
+                t.daemon = True
+                t.start()
+
     def get_request(self):
         conn, addr = self.socket.accept()
-        sconn = ssl.wrap_socket(conn, server_side=True,
-                                     certfile=CERT_FILE, keyfile=CERT_FILE,
-                                     ssl_version=ssl.PROTOCOL_SSLv23)
+        if not self.certs:
+            return (conn, addr)
+        # the handshake runs in the connection thread, a slow client only stalls itself
+        sconn = self.certs.get().wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
         return (sconn, addr)
 
+    def process_request(self, request, client_address):
+        if self.pool_size:
+            self.pending.put((request, client_address))
+        else:
+            SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def pool_worker(self):
+        while True:
+            request, client_address = self.pending.get()
+            self.process_request_thread(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        with self.active_lock:
+            self.active += 1
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.active_lock:
+                self.active -= 1
+
+    def finish_request(self, request, client_address):
+        if isinstance(request, ssl.SSLSocket):
+            request.settimeout(self.handshake_timeout)
+            started = time.time()
+            try:
+                request.do_handshake()
+            except (ssl.SSLError, socket.error, socket.timeout) as e:
+                logging.debug('handshake with %r failed: %r', client_address, e)
+                return
+            if self.metrics:
+                self.metrics.observe_handshake(time.time() - started)
+            request.settimeout(None)
+        BaseHTTPServer.HTTPServer.finish_request(self, request, client_address)
+
+    def drain(self, timeout=GRACEFUL_TIMEOUT):
+        """stop accepting and wait for in-flight requests"""
+        self.socket.close()
+        deadline = time.time() + timeout
+        while self.active and time.time() < deadline:
+            time.sleep(0.05)
+        if self.access_log:
+            self.access_log.flush()
+
+
+def _http_version(version):
+    """(major, minor) of an HTTP/x.y version, None when malformed, as BaseHTTPRequestHandler.parse_request checks it"""
+    if not version.startswith('HTTP/'):
+        return None
+    numbers = version[5:].split('.')
+    if len(numbers) != 2 or not all(x.isdigit() and len(x) <= 10 for x in numbers):
+        return None
+    return int(numbers[0]), int(numbers[1])
+
+
+class _Connection(object):
+    """state of one client connection in EventLoopServer"""
+
+    def __init__(self, sock, addr, handshaking):
+        self.sock = sock
+        self.addr = addr
+        self.handshaking = handshaking
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        # (file, offset, remaining) of a response body still to send
+        self.body = None
+        self.busy = False
+        self.reading = False
+        self.keep_alive = True
+        self.eof = False
+        self.closed = False
+        self.want = 0
+        self.events = 0
+        self.deadline = 0
+        self.accepted_at = time.time()
+        # metrics of the response in progress
+        self.path = '-'
+        self.status = None
+        self.request_started = None
+        self.ttfb = None
+        self.sent = 0
+
+
+class EventLoopServer(object):
+    """single thread selectors loop for keep-alive and pipelined HTTP/1.1, file i/o runs in a bounded thread pool
+
+    requests are resolved by RequestHandlerClass.send_head() in the pool, so the document root, listings,
+    ranges and sidecars are the same as ThreadingSimpleServer; idle connections cost a socket, not a thread.
+    """
+
+    certfile = CERT_FILE
+    handshake_timeout = HANDSHAKE_TIMEOUT
+    idle_timeout = IDLE_TIMEOUT
+    reuse_port = False
+    pool_size = IO_THREADS
+    cache_size = CACHE_SIZE
+    metrics_path = METRICS_PATH
+    access_log_stream = sys.stderr
+
+    def __init__(self, server_address, RequestHandlerClass):
+        self.RequestHandlerClass = RequestHandlerClass
+        self.directory = os.getcwd()
+        self.socket = socket.socket(socket.AF_INET6 if ':' in server_address[0] else socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+        self.socket.bind(server_address)
+        self.socket.listen(1024)
+        self.socket.setblocking(False)
+        self.certs = CertContext(self.certfile) if self.certfile else None
+        self.file_cache = FileCache(self.cache_size) if self.cache_size else None
+        self.listing_cache = ListingCache()
+        self.access_log = AccessLog(self.access_log_stream) if self.access_log_stream else None
+        self.metrics = Metrics(self) if self.metrics_path else None
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        # pool threads hand finished jobs back through a deque and wake the loop with a byte on a socketpair
+        self.waker, self.waker_w = socket.socketpair()
+        self.waker.setblocking(False)
+        self.waker_w.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ, self.waker)
+        self.completions = collections.deque()
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.pool_size)
+        self.connections = set()
+        self.swept_at = 0
+        self.shutdown_request = False
+
+    def serve_forever(self, poll_interval=0.5):
+        self.shutdown_request = False
+        while not self.shutdown_request:
+            self.run_once(poll_interval)
+
+    def shutdown(self):
+        self.shutdown_request = True
+        self.wakeup()
+
+    def drain(self, timeout=GRACEFUL_TIMEOUT):
+        """stop accepting and finish the responses in flight"""
+        if self.socket.fileno() >= 0:
+            self.selector.unregister(self.socket)
+            self.socket.close()
+        deadline = time.time() + timeout
+        while any(conn.busy for conn in self.connections) and time.time() < deadline:
+            self.run_once(0.05)
+        for conn in list(self.connections):
+            self.close(conn)
+        self.pool.shutdown(wait=False)
+        if self.access_log:
+            self.access_log.flush()
+
+    def wakeup(self):
+        try:
+            self.waker_w.send(b'\0')
+        except socket.error:
+            pass
+
+    def run_once(self, timeout):
+        for key, mask in self.selector.select(timeout):
+            if key.data is None:
+                self.accept()
+            elif key.data is self.waker:
+                try:
+                    self.waker.recv(4096)
+                except socket.error:
+                    pass
+            else:
+                self.on_event(key.data, mask)
+        while self.completions:
+            self.on_complete(*self.completions.popleft())
+        now = time.time()
+        if now - self.swept_at >= 1:
+            self.swept_at = now
+            # a request waiting on the pool is not idle, a response stuck on a client that stopped reading is
+            for conn in [x for x in self.connections if x.deadline < now and not x.reading and (x.want or not x.busy)]:
+                logging.debug('closing idle connection from %r', conn.addr)
+                self.close(conn)
+
+    def accept(self):
+        for _ in range(64):
+            try:
+                sock, addr = self.socket.accept()
+            except socket.error:
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.certs:
+                sock = self.certs.get().wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+            conn = _Connection(sock, addr, bool(self.certs))
+            conn.deadline = time.time() + (self.handshake_timeout if self.certs else self.idle_timeout)
+            conn.want = selectors.EVENT_READ
+            self.connections.add(conn)
+            self.update(conn)
+
+    def update(self, conn):
+        if conn.closed:
+            return
+        events = conn.want
+        if not conn.handshaking and not conn.eof and len(conn.inbuf) < MAX_REQUEST_BUFFER:
+            events |= selectors.EVENT_READ
+        if events == conn.events:
+            return
+        if not events:
+            self.selector.unregister(conn.sock)
+        elif not conn.events:
+            self.selector.register(conn.sock, events, conn)
+        else:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+    def close(self, conn):
+        if conn.closed:
+            return
+        if conn.events:
+            self.selector.unregister(conn.sock)
+        conn.closed = True
+        self.connections.discard(conn)
+        if conn.body and not conn.reading:
+            # otherwise the pool still reads from it, on_complete closes it
+            conn.body[0].close()
+            conn.body = None
+        conn.sock.close()
+
+    def on_event(self, conn, mask):
+        if conn.handshaking:
+            self.handshake(conn)
+        else:
+            if mask & selectors.EVENT_READ:
+                self.read(conn)
+            if mask & selectors.EVENT_WRITE and not conn.closed:
+                self.write(conn)
+        self.update(conn)
+
+    def handshake(self, conn):
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            conn.want = selectors.EVENT_READ
+            return
+        except ssl.SSLWantWriteError:
+            conn.want = selectors.EVENT_WRITE
+            return
+        except (ssl.SSLError, socket.error) as e:
+            logging.debug('handshake with %r failed: %r', conn.addr, e)
+            self.close(conn)
+            return
+        conn.handshaking = False
+        conn.want = 0
+        if self.metrics:
+            self.metrics.observe_handshake(time.time() - conn.accepted_at)
+        conn.deadline = time.time() + self.idle_timeout
+        # the client may have sent its request along with the handshake
+        self.read(conn)
+
+    def read(self, conn):
+        while len(conn.inbuf) < MAX_REQUEST_BUFFER:
+            try:
+                data = conn.sock.recv(65536)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                break
+            except socket.error:
+                self.close(conn)
+                return
+            if not data:
+                conn.eof = True
+                break
+            conn.inbuf += data
+        conn.deadline = time.time() + self.idle_timeout
+        self.next_request(conn)
+
+    def next_request(self, conn):
+        """parse the next buffered request and hand it to the pool, responses keep the request order"""
+        if conn.busy or conn.closed:
+            return
+        end = conn.inbuf.find(b'\r\n\r\n')
+        if end < 0:
+            if conn.eof or len(conn.inbuf) >= MAX_REQUEST_BUFFER:
+                self.close(conn)
+            return
+        lines = bytes(conn.inbuf[:end + 4]).split(b'\r\n', 1)
+        requestline = lines[0].decode('iso-8859-1')
+        words = requestline.split()
+        version_number = _http_version(words[2]) if len(words) == 3 else None
+        if version_number is None:
+            self.respond_error(conn, 400)
+            return
+        if version_number >= (2, 0):
+            self.respond_error(conn, 505)
+            return
+        headers = http.client.parse_headers(io.BytesIO(lines[1]))
+        if headers.get('Transfer-Encoding'):
+            self.respond_error(conn, 501)
+            return
+        try:
+            length = int(headers.get('Content-Length', 0))
+        except ValueError:
+            self.respond_error(conn, 400)
+            return
+        if len(conn.inbuf) < end + 4 + length:
+            if length > MAX_REQUEST_BUFFER:
+                self.respond_error(conn, 413)
+            return
+        del conn.inbuf[:end + 4 + length]
+        command, path, version = words
+        conn.path, conn.status, conn.request_started, conn.ttfb, conn.sent = path, None, time.time(), None, 0
+        connection = headers.get('Connection', '').lower()
+        if version_number < (1, 1):
+            conn.keep_alive = 'keep-alive' in connection
+        else:
+            conn.keep_alive = 'close' not in connection
+        conn.busy = True
+        future = self.pool.submit(self.respond, conn, requestline, command, path, version, headers)
+        future.add_done_callback(lambda future: self.complete(conn, 'response', future))
+
+    def respond_error(self, conn, code):
+        status = '%d %s' % (code, BaseHTTPServer.BaseHTTPRequestHandler.responses[code][0])
+        if not conn.busy:
+            # the request could not be parsed, it has no path
+            conn.path, conn.request_started, conn.ttfb, conn.sent = '-', time.time(), None, 0
+        conn.outbuf += ('HTTP/1.1 %s\r\nConnection: close\r\nContent-Length: 0\r\n\r\n' % status).encode()
+        conn.status = code
+        conn.keep_alive = False
+        conn.busy = True
+        self.write(conn)
+
+    def respond(self, conn, requestline, command, path, version, headers):
+        """runs in the pool, returns (status line and headers, body) from the request handler"""
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.server = self
+        handler.client_address = conn.addr
+        handler.directory = self.directory
+        handler.protocol_version = 'HTTP/1.1'
+        handler.requestline, handler.command, handler.path, handler.request_version = requestline, command, path, version
+        handler.headers = headers
+        handler.close_connection = False
+        handler.wfile = io.BytesIO()
+        f = None
+        if command in ('GET', 'HEAD'):
+            f = handler.send_head()
+        else:
+            handler.send_error(501, 'Unsupported method (%r)' % command)
+        head = handler.wfile.getvalue()
+        conn.status = handler.status
+        if handler.close_connection:
+            conn.keep_alive = False
+        elif conn.keep_alive and version == 'HTTP/1.0':
+            head = head[:-2] + b'Connection: keep-alive\r\n\r\n'
+        if f is None:
+            return head, None
+        if command == 'HEAD':
+            f.close()
+            return head, None
+        if handler.body_range is None:
+            # directory listings come back as an in-memory file
+            try:
+                return head + f.read(), None
+            finally:
+                f.close()
+        offset, length = handler.body_range
+        if not length:
+            f.close()
+            return head, None
+        return head, (f, offset, length)
+
+    def complete(self, conn, kind, future):
+        self.completions.append((conn, kind, future))
+        self.wakeup()
+
+    def on_complete(self, conn, kind, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.exception('%s for %r failed: %r', kind, conn.addr, e)
+            result = None
+        if kind == 'chunk':
+            conn.reading = False
+            if conn.closed or not result:
+                conn.body[0].close()
+                self.close(conn)
+                return
+            f, offset, remaining = conn.body
+            conn.outbuf += result
+            conn.body = (f, offset + len(result), remaining - len(result))
+        else:
+            if conn.closed:
+                if result and result[1]:
+                    result[1][0].close()
+                return
+            if result is None:
+                self.respond_error(conn, 500)
+                return
+            conn.outbuf += result[0]
+            conn.body = result[1]
+        self.write(conn)
+        self.update(conn)
+
+    def sent(self, conn, n):
+        now = time.time()
+        conn.deadline = now + self.idle_timeout
+        conn.sent += n
+        if conn.ttfb is None and conn.request_started:
+            conn.ttfb = now - conn.request_started
+
+    def write(self, conn):
+        conn.want = 0
+        while not conn.closed:
+            if conn.outbuf:
+                try:
+                    n = conn.sock.send(conn.outbuf)
+                except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+                    conn.want = selectors.EVENT_WRITE
+                    return
+                except socket.error:
+                    self.close(conn)
+                    return
+                del conn.outbuf[:n]
+                self.sent(conn, n)
+            elif conn.body and conn.body[2] <= 0:
+                conn.body[0].close()
+                conn.body = None
+            elif conn.body and not self.certs:
+                # plaintext, the kernel moves the bytes straight from the page cache
+                f, offset, remaining = conn.body
+                try:
+                    n = os.sendfile(conn.sock.fileno(), f.fileno(), offset, min(remaining, COPY_CHUNK_SIZE * 4))
+                except BlockingIOError:
+                    conn.want = selectors.EVENT_WRITE
+                    return
+                except (OSError, IOError):
+                    self.close(conn)
+                    return
+                if not n:
+                    # the file shrank under us
+                    self.close(conn)
+                    return
+                conn.body = (f, offset + n, remaining - n)
+                self.sent(conn, n)
+            elif conn.body:
+                # over TLS the next chunk is read in the pool, the loop never waits on the disk
+                if not conn.reading:
+                    f, offset, remaining = conn.body
+                    conn.reading = True
+                    future = self.pool.submit(os.pread, f.fileno(), min(remaining, COPY_CHUNK_SIZE), offset)
+                    future.add_done_callback(lambda future: self.complete(conn, 'chunk', future))
+                return
+            else:
+                conn.busy = False
+                if self.metrics and conn.status is not None:
+                    self.metrics.observe_request(conn.status, conn.path, conn.ttfb, conn.sent)
+                    conn.status = None
+                if not conn.keep_alive:
+                    self.close(conn)
+                    return
+                # a pipelined request may be waiting in the buffer already
+                self.next_request(conn)
+                return
+
+
+def serve(args, server_class=ThreadingSimpleServer):
+    httpd = server_class((args.bind, args.port), HTTPSRequestHandler)
+    logging.info('Serving %s on %s port %s ...', 'HTTP' if args.plain else 'HTTPS', *httpd.socket.getsockname()[:2])
+    # shutdown() waits for serve_forever() to return, so it can not run in the signal handler itself
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=httpd.shutdown).start())
+    if httpd.file_cache:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: logging.info('file cache %s', httpd.file_cache.stats()))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.drain()
+
+
+def prefork(args, server_class=ThreadingSimpleServer):
+    """master process, keeps args.workers children serving on SO_REUSEPORT sockets
+
+    crashed workers are restarted, SIGHUP starts a new generation and drains the old one, SIGTERM/SIGINT stop all.
+    """
+    server_class.reuse_port = True
+    events = []
+    signal.signal(signal.SIGHUP, lambda signum, frame: events.append('reload'))
+    signal.signal(signal.SIGTERM, lambda signum, frame: events.append('stop'))
+    signal.signal(signal.SIGINT, lambda signum, frame: events.append('stop'))
+    children = {}
+    # SIGUSR1 is passed on, every worker logs its own cache counters
+    signal.signal(signal.SIGUSR1, lambda signum, frame: [os.kill(pid, signal.SIGUSR1) for pid in children])
+    generation = 0
+    crashed_at = 0
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                for signum in (signal.SIGHUP, signal.SIGTERM):
+                    signal.signal(signum, signal.SIG_DFL)
+                # ctrl-c reaches the whole process group, the master decides what happens
+                for signum in (signal.SIGINT, signal.SIGUSR1):
+                    signal.signal(signum, signal.SIG_IGN)
+                serve(args, server_class)
+            except BaseException:
+                logging.exception('worker %d failed', os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = (generation, time.time())
+
+    logging.info('prefork master %d starting %d workers', os.getpid(), args.workers)
+    while 'stop' not in events:
+        if 'reload' in events:
+            events.remove('reload')
+            generation += 1
+            old = list(children)
+            for _ in range(args.workers):
+                spawn()
+            logging.info('reload: generation %d started, draining %d old workers', generation, len(old))
+            for pid in old:
+                os.kill(pid, signal.SIGTERM)
+        while sum(1 for x in children.values() if x[0] == generation) < args.workers:
+            if time.time() - crashed_at < 1:
+                # a worker which dies right after start would otherwise turn into a fork loop
+                break
+            spawn()
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            pid = 0
+        if pid in children:
+            child_generation, started_at = children.pop(pid)
+            if child_generation == generation:
+                logging.error('worker %d exited with status %d, restarting', pid, status)
+                if time.time() - started_at < 1:
+                    crashed_at = time.time()
+            continue
+        time.sleep(0.1)
+    logging.info('prefork master %d stopping %d workers', os.getpid(), len(children))
+    for pid in children:
+        os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + GRACEFUL_TIMEOUT + 1
+    while children and time.time() < deadline:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            children.pop(pid, None)
+        else:
+            time.sleep(0.05)
+    for pid in children:
+        os.kill(pid, signal.SIGKILL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='serve the current directory over https')
+    parser.add_argument('port', nargs='?', type=int, default=8000)
+    parser.add_argument('--bind', default='')
+    parser.add_argument('--cert', default=CERT_FILE, help='pem file holding both the certificate and the key')
+    parser.add_argument('--handshake-timeout', type=float, default=HANDSHAKE_TIMEOUT)
+    parser.add_argument('--plain', action='store_true', help='serve plain http, files go out with sendfile')
+    parser.add_argument('--workers', type=int, default=0, help='prefork N processes sharing the port with SO_REUSEPORT')
+    parser.add_argument('--threads', type=int, default=0, help='thread pool size per process, 0 is a thread per connection (%d file i/o threads with --engine loop)' % IO_THREADS)
+    parser.add_argument('--engine', choices=('thread', 'loop'), default='thread', help='loop serves keep-alive connections from one selectors loop')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT, help='keep-alive timeout of --engine loop')
+    parser.add_argument('--metrics-path', default=METRICS_PATH, help='prometheus text (?format=json for json) served to loopback clients, empty disables')
+    parser.add_argument('--access-log', default='-', help='file the access log is appended to in batches, - is stderr, empty disables')
+    parser.add_argument('--cache-size', type=float, default=CACHE_SIZE / 1048576, help='MB of small files kept in memory, 0 disables, SIGUSR1 logs its counters')
+    args = parser.parse_args()
+    if args.engine == 'loop' and not selectors:
+        parser.error('--engine loop needs python 3')
+    logging.basicConfig(format='%(asctime)s %(process)d %(levelname)s %(message)s', level=logging.INFO)
+    server_class = EventLoopServer if args.engine == 'loop' else ThreadingSimpleServer
+    server_class.certfile = None if args.plain else args.cert
+    server_class.handshake_timeout = args.handshake_timeout
+    server_class.pool_size = args.threads or server_class.pool_size
+    server_class.cache_size = int(args.cache_size * 1048576)
+    server_class.metrics_path = args.metrics_path
+    if args.access_log != '-':
+        server_class.access_log_stream = open(args.access_log, 'a') if args.access_log else None
+    if args.engine == 'loop':
+        server_class.idle_timeout = args.idle_timeout
+    if args.workers:
+        prefork(args, server_class)
+    else:
+        serve(args, server_class)
+
+
 if __name__ == '__main__':
-    SimpleHTTPServer.test(ServerClass=ThreadingSimpleServer)
+    main()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+usage: python httpsserver_bench.py [--duration 5] [--concurrency 8] [--slow-clients 50] [--modes thread,loop] [--docroot ..]
+
+starts httpsserver.py on loopback in each of its modes with a throwaway self-signed cert, drives it with
+keep-alive clients (TLS, or plain http in the plain modes) over small files, soft/ archives and directory
+listings, and prints JSON results
+"""
+
+import sys
+import os
+import ssl
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import multiprocessing
+import urllib.parse
+
+HTTPSSERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'httpsserver.py')
+DOCROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CPUS = os.cpu_count() or 1
+# name -> extra httpsserver.py arguments
+MODES = {
+    'thread': [],
+    'thread-pool': ['--threads', '32'],
+    'loop': ['--engine', 'loop'],
+    'prefork': ['--workers', str(CPUS)],
+    'prefork-loop': ['--workers', str(CPUS), '--engine', 'loop'],
+    # no tls, files go out with sendfile
+    'plain': ['--plain'],
+    'plain-loop': ['--plain', '--engine', 'loop'],
+}
+SMALL_FILE_SIZE = 64 * 1024
+
+
+def make_cert(directory):
+    certfile = os.path.join(directory, 'cert.pem')
+    subprocess.check_call(['openssl', 'req', '-new', '-x509', '-days', '1', '-nodes', '-subj', '/CN=localhost',
+                           '-newkey', 'rsa:2048', '-out', certfile, '-keyout', certfile],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def scenarios(docroot):
+    """url paths per scenario, taken from the files under docroot"""
+    quote = lambda path: urllib.parse.quote(path.replace(os.sep, '/'))
+    small = []
+    for directory in ('', 'topic'):
+        for name in sorted(os.listdir(os.path.join(docroot, directory) or '.')):
+            path = os.path.join(docroot, directory, name)
+            if os.path.isfile(path) and os.path.getsize(path) <= SMALL_FILE_SIZE:
+                small.append('/' + quote(os.path.join(directory, name)))
+    soft = ['/soft/' + quote(name) for name in sorted(os.listdir(os.path.join(docroot, 'soft')))] if os.path.isdir(os.path.join(docroot, 'soft')) else []
+    listing = ['/' + quote(name) + '/' for name in sorted(os.listdir(docroot)) if os.path.isdir(os.path.join(docroot, name)) and not name.startswith('.')]
+    listing += [path + '?format=json' for path in listing]
+    return {'small': small, 'soft': soft, 'listing': listing}
+
+
+def start_server(docroot, certfile, *args):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, HTTPSSERVER, str(port), '--bind', '127.0.0.1', '--cert', certfile, '--access-log', ''] + list(args),
+                            cwd=docroot, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc, port
+        except socket.error:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError('httpsserver.py did not start on port %d' % port)
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def client_context():
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    pick = lambda q: samples[min(int(len(samples) * q), len(samples) - 1)] * 1000
+    return {'p50_ms': round(pick(0.5), 3), 'p99_ms': round(pick(0.99), 3), 'p999_ms': round(pick(0.999), 3), 'max_ms': round(samples[-1] * 1000, 3)}
+
+
+def run_threads(concurrency, target):
+    threads = [threading.Thread(target=target) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def bench_handshakes(port, concurrency, duration, resume=False):
+    """full (or resumed) TLS handshakes per second, every handshake on a fresh connection"""
+    context = client_context()
+    deadline = time.time() + duration
+    latencies = []
+    resumed = [0]
+
+    def worker():
+        session = None
+        while time.time() < deadline:
+            start = time.time()
+            sock = socket.create_connection(('127.0.0.1', port))
+            sconn = context.wrap_socket(sock, server_hostname='localhost', session=session if resume else None)
+            latencies.append(time.time() - start)
+            resumed[0] += sconn.session_reused
+            # tls 1.3 tickets only arrive with application data
+            sconn.sendall(b'HEAD / HTTP/1.0\r\n\r\n')
+            while sconn.recv(65536):
+                pass
+            session = sconn.session
+            sconn.close()
+
+    start = time.time()
+    run_threads(concurrency, worker)
+    elapsed = time.time() - start
+    result = {'handshakes': len(latencies), 'handshakes_per_s': round(len(latencies) / elapsed, 1), 'resumed': resumed[0]}
+    result.update(percentiles(latencies))
+    return result
+
+
+def _request_worker(job):
+    """one client process, `threads` keep-alive connections cycling through paths until the deadline"""
+    port, paths, threads, deadline, offset, tls = job
+    context = client_context()
+    latencies = []
+    counters = [0, 0]
+
+    def worker(index):
+        if tls:
+            conn = http.client.HTTPSConnection('127.0.0.1', port, context=context, timeout=30)
+        else:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        i = offset + index
+        while time.time() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.time()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                size = len(response.read())
+                if response.status != 200:
+                    raise http.client.HTTPException('status %d' % response.status)
+            except (http.client.HTTPException, socket.error):
+                # a server which closes the connection gets a fresh one on the next request
+                counters[1] += 1
+                conn.close()
+                continue
+            latencies.append(time.time() - start)
+            counters[0] += size
+        conn.close()
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return latencies, counters[0], counters[1]
+
+
+def bench_requests(port, paths, concurrency, duration, tls=True):
+    """requests/s, MB/s and latency of `concurrency` keep-alive clients spread over client processes"""
+    processes = max(min(CPUS, concurrency), 1)
+    deadline = time.time() + duration
+    jobs = [(port, paths, concurrency // processes + (i < concurrency % processes), deadline, i * concurrency, tls) for i in range(processes)]
+    start = time.time()
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(_request_worker, jobs)
+    elapsed = time.time() - start
+    latencies = [x for result in results for x in result[0]]
+    size = sum(result[1] for result in results)
+    result = {'requests': len(latencies), 'requests_per_s': round(len(latencies) / elapsed, 1),
+              'mb_per_s': round(size / elapsed / 1048576, 2), 'errors': sum(result[2] for result in results)}
+    result.update(percentiles(latencies))
+    return result
+
+
+def bench_accept_latency(port, slow_clients, samples=50):
+    """connect + handshake time of a fresh client while slow clients sit on unfinished handshakes"""
+    context = client_context()
+    slow = [socket.create_connection(('127.0.0.1', port)) for _ in range(slow_clients)]
+    try:
+        latencies = []
+        for _ in range(samples):
+            start = time.time()
+            sock = socket.create_connection(('127.0.0.1', port), timeout=30)
+            sconn = context.wrap_socket(sock, server_hostname='localhost')
+            latencies.append(time.time() - start)
+            sconn.close()
+    finally:
+        for sock in slow:
+            sock.close()
+    result = {'slow_clients': slow_clients, 'samples': samples}
+    result.update(percentiles(latencies))
+    return result
+
+
+def bench_mode(docroot, certfile, name, args, paths):
+    proc, port = start_server(docroot, certfile, *MODES[name])
+    try:
+        if name.startswith('prefork'):
+            # every worker has to be listening before the numbers mean anything
+            time.sleep(1)
+        tls = '--plain' not in MODES[name]
+        results = {}
+        if tls:
+            # the plain modes have no handshake to measure
+            results['handshake_full'] = bench_handshakes(port, args.concurrency, args.duration)
+            results['handshake_resumed'] = bench_handshakes(port, args.concurrency, args.duration, resume=True)
+            results['accept_under_slow_clients'] = bench_accept_latency(port, args.slow_clients)
+        for scenario in args.scenarios.split(','):
+            if paths[scenario]:
+                results[scenario] = bench_requests(port, paths[scenario], args.concurrency, args.duration, tls)
+        return results
+    finally:
+        stop_server(proc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark httpsserver.py on loopback')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--slow-clients', type=int, default=50)
+    parser.add_argument('--modes', default=','.join(MODES), help='comma separated, of %s' % ', '.join(MODES))
+    parser.add_argument('--scenarios', default='small,soft,listing')
+    parser.add_argument('--docroot', default=DOCROOT, help='tree to serve, the repository root by default')
+    args = parser.parse_args()
+    paths = scenarios(args.docroot)
+    directory = tempfile.mkdtemp(prefix='httpsserver_bench_')
+    try:
+        certfile = make_cert(directory)
+        results = {
+            'meta': {'python': sys.version.split()[0], 'cpus': CPUS, 'duration': args.duration, 'concurrency': args.concurrency,
+                     'paths': dict((name, len(value)) for name, value in paths.items())},
+            'modes': dict((name, bench_mode(args.docroot, certfile, name, args, paths)) for name in args.modes.split(',')),
+        }
+    finally:
+        shutil.rmtree(directory)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
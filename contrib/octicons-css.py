@@ -6,59 +6,325 @@ import os
 import re
 import time
 import json
+import errno
+import socket
+import hashlib
+import tempfile
+import urllib
 import urllib2
+import httplib
+import logging
+import argparse
+import threading
+import urlparse
+import Queue
 
 PRIMER_OCTICONS_URL = 'https://raw.githubusercontent.com/primer/octicons/master/lib/'
+CACHE_DIR = os.path.expanduser('~/.cache/octicons-css')
+CONCURRENCY = 8
+FETCH_TIMEOUT = 30
+# percent-encoded in --urlencode data uris, '#' would otherwise end the uri
+URLENCODE_SAFE = " '=/:;,.-_()!*~?&@$+"
+
+TEMPLATE = '''.octicon-{{ name }} {
+background-position: center left;
+background-repeat: no-repeat;
+background-image: linear-gradient(transparent,transparent),url("data:image/svg+xml;{{ charset }},{{ svg }}");
+padding-left: 16px;
+}'''
+MINIFIED_TEMPLATE = '.octicon-{{ name }}{background-position:center left;background-repeat:no-repeat;background-image:linear-gradient(transparent,transparent),url("data:image/svg+xml;{{ charset }},{{ svg }}");padding-left:16px}'
+
+SHAPE_RE = re.compile(r'id="Shape"></.+$')
+TEMPLATE_VAR_RE = re.compile(r'(?is){{ (\w+) }}')
+
+
+class IconFetcher(object):
+    """fetch files under PRIMER_OCTICONS_URL over a few keep-alive connections, revalidating a disk cache
+
+    the cache keeps the layout of the source (data.json, svg/NAME.svg) plus a .meta file holding the
+    ETag/Last-Modified, so a cache directory also works as an offline source.
+    """
+
+    def __init__(self, source=PRIMER_OCTICONS_URL, cache_dir=CACHE_DIR, concurrency=CONCURRENCY, offline=False):
+        self.source = source.rstrip('/') + '/'
+        self.local = '://' not in source
+        self.cache_dir = cache_dir
+        self.concurrency = concurrency
+        self.offline = offline
+        self.pool = Queue.Queue()
+        self.stats = {'fetched': 0, 'revalidated': 0, 'cached': 0}
+        self.lock = threading.Lock()
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def connect(self):
+        url = urlparse.urlsplit(self.source)
+        if url.scheme == 'https':
+            return httplib.HTTPSConnection(url.netloc, timeout=FETCH_TIMEOUT)
+        return httplib.HTTPConnection(url.netloc, timeout=FETCH_TIMEOUT)
+
+    def request(self, path, headers):
+        """GET over a pooled connection, retried once on a fresh one when a kept-alive connection went stale"""
+        try:
+            conn = self.pool.get_nowait()
+        except Queue.Empty:
+            conn = self.connect()
+        url = urlparse.urlsplit(self.source).path + urllib.quote(path)
+        for retry in (True, False):
+            try:
+                conn.request('GET', url, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not retry:
+                    raise
+                conn = self.connect()
+        if response.getheader('connection', '').lower() == 'close' or response.version < 11:
+            conn.close()
+        else:
+            self.pool.put(conn)
+        return response, data
+
+    def cached(self, path):
+        filename = os.path.join(self.cache_dir, path)
+        try:
+            with open(filename, 'rb') as fp:
+                data = fp.read()
+            with open(filename + '.meta', 'rb') as fp:
+                meta = json.load(fp)
+        except (IOError, ValueError):
+            return None, {}
+        return data, meta
+
+    def store(self, path, data, meta):
+        filename = os.path.join(self.cache_dir, path)
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        for name, content in ((filename, data), (filename + '.meta', json.dumps(meta))):
+            with open(name + '.tmp', 'wb') as fp:
+                fp.write(content)
+            os.rename(name + '.tmp', name)
+
+    def get(self, path):
+        if self.local:
+            with open(os.path.join(self.source, path), 'rb') as fp:
+                return fp.read()
+        data, meta = self.cached(path)
+        if self.offline:
+            if data is None:
+                raise IOError('%r is not in the cache %r' % (path, self.cache_dir))
+            self.count('cached')
+            return data
+        headers = {}
+        if data is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            response, body = self.request(path, headers)
+        except (httplib.HTTPException, socket.error) as e:
+            if data is None:
+                raise
+            logging.warning('fetch %r failed: %r, using the cached copy', path, e)
+            self.count('cached')
+            return data
+        if response.status == 304 and data is not None:
+            self.count('revalidated')
+            return data
+        if response.status != 200:
+            raise urllib2.HTTPError(self.source + path, response.status, response.reason, response.msg, None)
+        self.store(path, body, {'etag': response.getheader('etag'), 'last_modified': response.getheader('last-modified')})
+        self.count('fetched')
+        return body
+
+    def get_many(self, paths):
+        """{path: data} of paths, at most `concurrency` requests in flight"""
+        pending = Queue.Queue()
+        for path in paths:
+            pending.put(path)
+        results = {}
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    path = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[path] = self.get(path)
+                except Exception as e:
+                    errors.append((path, e))
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.concurrency, len(paths)) or 1)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            path, e = errors[0]
+            raise IOError('fetch %r failed: %r' % (path, e))
+        return results
 
 
-def get_icon_list():
-    data = urllib2.urlopen(PRIMER_OCTICONS_URL + 'data.json').read()
+def get_icon_list(fetcher=None):
+    if fetcher:
+        data = fetcher.get('data.json')
+    else:
+        data = urllib2.urlopen(PRIMER_OCTICONS_URL + 'data.json').read()
     info = json.loads(data)
     icon_list = info.keys()
     return icon_list
 
 
-def get_icon_svg(name, minify=True):
-    data = urllib2.urlopen(PRIMER_OCTICONS_URL + 'svg/%s.svg' % name).read()
+def minify_svg(data):
+    lines = data.splitlines()
+    for line in lines:
+        line = line.strip()
+        if line.startswith('<svg '):
+            svg_line = line
+        elif line.startswith('<path '):
+            data_line = line
+        elif line.startswith('<polygon '):
+            data_line = line
+        else:
+            pass
+    data_line = SHAPE_RE.sub('fill="#7D94AE" />', data_line)
+    return svg_line + data_line + '</svg>'
+
+
+def get_icon_svg(name, minify=True, fetcher=None):
+    if fetcher:
+        data = fetcher.get('svg/%s.svg' % name)
+    else:
+        data = urllib2.urlopen(PRIMER_OCTICONS_URL + 'svg/%s.svg' % name).read()
     if minify:
-        lines = data.splitlines()
-        for line in lines:
-            line = line.strip()
-            if line.startswith('<svg '):
-                svg_line = line
-            elif line.startswith('<path '):
-                data_line = line
-            elif line.startswith('<polygon '):
-                data_line = line
-            else:
-                pass
-        data_line = re.sub(r'id="Shape"></.+$', 'fill="#7D94AE" />', data_line)
-        data = svg_line + data_line + '</svg>'
+        data = minify_svg(data)
     return data
 
 
+def get_icon_svgs(icon_list, fetcher, minify=True):
+    """{name: svg} of icon_list, fetched concurrently"""
+    paths = dict(('svg/%s.svg' % name, name) for name in icon_list)
+    svgs = {}
+    for path, data in fetcher.get_many(list(paths)).items():
+        svgs[paths[path]] = minify_svg(data) if minify else data
+    return svgs
+
+
+_compiled_templates = {}
+
+
+def compile_template(template):
+    """{{ var }} placeholders turned into a %-format string, done once per template"""
+    compiled = _compiled_templates.get(template)
+    if compiled is None:
+        compiled = _compiled_templates[template] = TEMPLATE_VAR_RE.sub(r'%(\1)s', template.replace('%', '%%'))
+    return compiled
+
+
+class _Vars(dict):
+    def __missing__(self, key):
+        return ''
+
+
 def render(template, vars):
-    return re.sub(r'(?is){{ (\w+) }}', lambda m: str(vars.get(m.group(1), '')), template)
+    return compile_template(template) % _Vars(vars)
 
 
-def convert_svg_to_css(name, svg):
-    TEMPLATE = '''.octicon-{{ name }} {
-background-position: center left;
-background-repeat: no-repeat;
-background-image: linear-gradient(transparent,transparent),url("data:image/svg+xml;utf8,{{ svg }}");
-padding-left: 16px;
-}'''
+def convert_svg_to_css(name, svg, minify=False, urlencode=False):
     svg = svg.replace('"', "'")
-    return render(TEMPLATE, locals())
+    if urlencode:
+        svg = urllib.quote(svg, URLENCODE_SAFE)
+    return render(MINIFIED_TEMPLATE if minify else TEMPLATE, {'name': name, 'svg': svg, 'charset': 'charset=utf8' if urlencode else 'utf8'})
+
+
+def build_css(icon_list, fetcher, output, minify=False, urlencode=False):
+    """write the stylesheet of icon_list to output, regenerating only the rules whose svg changed
+
+    output + '.manifest.json' maps each icon to the sha1 of its svg and the rule built from it, the
+    stylesheet is streamed to a temporary file next to output and renamed over it.
+    """
+    manifest_file = output + '.manifest.json'
+    options = {'minify': minify, 'urlencode': urlencode}
+    try:
+        with open(manifest_file, 'rb') as fp:
+            manifest = json.load(fp)
+    except (IOError, ValueError):
+        manifest = {}
+    rules = manifest.get('rules', {}) if manifest.get('options') == options else {}
+    svgs = fetcher.get_many(['svg/%s.svg' % name for name in icon_list])
+    directory = os.path.dirname(os.path.abspath(output))
+    changed = 0
+    new_rules = {}
+    with tempfile.NamedTemporaryFile('wb', dir=directory, prefix='.octicons-', delete=False) as fp:
+        try:
+            for name in icon_list:
+                data = svgs['svg/%s.svg' % name]
+                digest = hashlib.sha1(data).hexdigest()
+                rule = rules.get(name)
+                if not rule or rule[0] != digest:
+                    rule = [digest, convert_svg_to_css(name, minify_svg(data), minify, urlencode)]
+                    changed += 1
+                new_rules[name] = rule
+                fp.write(rule[1].encode('utf-8') if isinstance(rule[1], unicode) else rule[1])
+                fp.write('\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        except:
+            os.remove(fp.name)
+            raise
+    os.chmod(fp.name, 0o644)
+    os.rename(fp.name, output)
+    with open(manifest_file + '.tmp', 'wb') as fp:
+        json.dump({'options': options, 'rules': new_rules}, fp)
+    os.rename(manifest_file + '.tmp', manifest_file)
+    return changed
 
 
 def main():
-    icon_list = get_icon_list()
+    parser = argparse.ArgumentParser(description='print css rules with primer/octicons svg icons inlined as data uris')
+    parser.add_argument('--source', default=PRIMER_OCTICONS_URL, help='base url, or a local directory holding data.json and svg/*.svg')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='revalidated with ETag/Last-Modified, usable as an offline --source')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='keep-alive connections and requests in flight')
+    parser.add_argument('--offline', action='store_true', help='only use the cache, no network')
+    parser.add_argument('-o', '--output', help='stylesheet written atomically, with an incremental build manifest next to it')
+    parser.add_argument('--minify', action='store_true', help='one line per rule')
+    parser.add_argument('--urlencode', action='store_true', help='percent-encode the svg data uris')
+    parser.add_argument('--icons', help='comma separated icon names, or @FILE with one per line, for a subset stylesheet')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    fetcher = IconFetcher(args.source, args.cache_dir, args.concurrency, args.offline)
+    start = time.time()
+    icon_list = get_icon_list(fetcher)
+    if args.icons:
+        if args.icons.startswith('@'):
+            with open(args.icons[1:]) as fp:
+                wanted = fp.read().split()
+        else:
+            wanted = [x.strip() for x in args.icons.split(',') if x.strip()]
+        unknown = set(wanted) - set(icon_list)
+        if unknown:
+            parser.error('unknown icons: %s' % ', '.join(sorted(unknown)))
+        icon_list = wanted
+    if args.output:
+        changed = build_css(icon_list, fetcher, args.output, args.minify, args.urlencode)
+        logging.info('%d icons, %d rules rebuilt in %.2fs, %r', len(icon_list), changed, time.time() - start, fetcher.stats)
+        return
+    svgs = get_icon_svgs(icon_list, fetcher)
+    logging.info('%d icons in %.2fs, %r', len(svgs), time.time() - start, fetcher.stats)
     for name in icon_list:
-        svg = get_icon_svg(name)
-        print convert_svg_to_css(name, svg)
+        print convert_svg_to_css(name, svgs[name], args.minify, args.urlencode)
 
 
 if __name__ == '__main__':
     main()
-
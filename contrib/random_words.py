@@ -3,6 +3,11 @@
 
 import sys, os, re, time
 import random
+import math, struct, hashlib, binascii, argparse
+
+CONSONANTS = 'bcdfghjklmnpqrstvwxyz'
+VOWELS = 'aeiou'
+BATCH_SIZE = 16384
 
 def random_word(length):
     return u''.join(random.choice(('bcdfghjklmnpqrstvwxyz','aeiou')[x&1]) for x in xrange(length))
@@ -10,6 +15,109 @@ def random_word(length):
 def random_words(count, minlength, maxlength):
     return u'-'.join(random_word(random.randint(minlength,maxlength)) for x in xrange(count))
 
+def translate_table(alphabet):
+    """str.translate arguments mapping random bytes onto alphabet uniformly, the bytes past the last full cycle are dropped"""
+    limit = 256 - 256 % len(alphabet)
+    table = ''.join(alphabet[i % len(alphabet)] for i in xrange(limit)) + '\0' * (256 - limit)
+    return table, ''.join(chr(i) for i in xrange(limit, 256))
+
+class WordGenerator(object):
+    """hostname-like words in batches: random bytes are drawn in bulk and mapped to letters by str.translate
+
+    words alternate consonant/vowel like random_word(), with a seed the output is reproducible.
+    """
+    consonants = translate_table(CONSONANTS)
+    vowels = translate_table(VOWELS)
+
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed) if seed is not None else None
+        self.tables = {}
+
+    def randbytes(self, n):
+        if self.rng is None:
+            return os.urandom(n)
+        return binascii.unhexlify('%0*x' % (n * 2, self.rng.getrandbits(n * 8)))
+
+    def letters(self, table, n):
+        chunks = []
+        while n > 0:
+            # a few spare bytes cover the dropped ones, rarely a second round
+            chunk = self.randbytes(n + n // 8 + 16).translate(*table)[:n]
+            chunks.append(chunk)
+            n -= len(chunk)
+        return ''.join(chunks)
+
+    def numbers(self, low, high, n):
+        """n uniform integers in [low, high], high - low < 256"""
+        table = self.tables.get((low, high))
+        if table is None:
+            table = self.tables[low, high] = translate_table(''.join(chr(i) for i in xrange(high - low + 1)))
+        return [low + ord(x) for x in self.letters(table, n)]
+
+    def batch(self, count, minwords, maxwords, minlength, maxlength):
+        words_per_line = self.numbers(minwords, maxwords, count)
+        lengths = self.numbers(minlength, maxlength, sum(words_per_line))
+        # one long consonant/vowel alternating string, every word is a slice of it starting at an even offset
+        size = sum(lengths) + len(lengths)
+        size += size & 1
+        buf = bytearray(size)
+        buf[0::2] = self.letters(self.consonants, size // 2)
+        buf[1::2] = self.letters(self.vowels, size // 2)
+        letters = str(buf)
+        words = []
+        offset = 0
+        for length in lengths:
+            words.append(letters[offset:offset + length])
+            offset += length + (length & 1)
+        lines = []
+        i = 0
+        for n in words_per_line:
+            lines.append('-'.join(words[i:i + n]))
+            i += n
+        return lines
+
+class BloomFilter(object):
+    """fixed size set membership, add() may wrongly say seen with error_rate probability at capacity"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+
+    def add(self, item):
+        """True when item was not seen before"""
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        new = False
+        for i in xrange(self.hashes):
+            bit = (h1 + i * h2) % self.bits
+            mask = 1 << (bit & 7)
+            if not self.array[bit >> 3] & mask:
+                self.array[bit >> 3] |= mask
+                new = True
+        return new
+
+def generate(count, minwords=2, maxwords=10, minlength=3, maxlength=10, seed=None, unique=False, error_rate=0.001):
+    """yields batches of lines, count lines in total; unique lines are deduplicated with a BloomFilter sized for count"""
+    generator = WordGenerator(seed)
+    seen = None
+    if unique:
+        words = sum(len(CONSONANTS) ** ((n + 1) // 2) * len(VOWELS) ** (n // 2) for n in xrange(minlength, maxlength + 1))
+        if count > sum(words ** n for n in xrange(minwords, maxwords + 1)):
+            raise ValueError('there are fewer than %d distinct lines of %d-%d words of %d-%d letters' % (count, minwords, maxwords, minlength, maxlength))
+        seen = BloomFilter(count, error_rate)
+    stalled = 0
+    while count > 0:
+        lines = generator.batch(min(count, BATCH_SIZE), minwords, maxwords, minlength, maxlength)
+        if seen:
+            lines = [x for x in lines if seen.add(x)]
+            # close to the size of the space almost every draw is a repeat
+            stalled = 0 if lines else stalled + 1
+            if stalled >= 100:
+                raise ValueError('no new unique line in 100 batches, %d lines short' % count)
+        count -= len(lines)
+        if lines:
+            yield lines
+
 def test():
     maxcount = 10
     maxlength = 10
@@ -18,5 +126,33 @@ def test():
     urls = [u'http://%s.google.com' % random_words(random.randint(2, maxcount), 3, maxlength) for i in xrange(lines) ]
     print '\n'.join(urls)
 
+def main():
+    parser = argparse.ArgumentParser(description='stream random hostname-like words, one line each')
+    parser.add_argument('count', type=int)
+    parser.add_argument('--words', default='2-10', help='words per line, MIN-MAX')
+    parser.add_argument('--length', default='3-10', help='letters per word, MIN-MAX')
+    parser.add_argument('--format', default='%s', help="e.g. 'http://%%s.google.com'")
+    parser.add_argument('--seed', type=int, help='reproducible output')
+    parser.add_argument('--unique', action='store_true', help='no line twice, a Bloom filter of about 1.8 bytes per line')
+    args = parser.parse_args()
+    minwords, maxwords = map(int, args.words.split('-'))
+    minlength, maxlength = map(int, args.length.split('-'))
+    if not 0 < minwords <= maxwords < 256 or not 0 < minlength <= maxlength < 256:
+        parser.error('ranges must be MIN-MAX within 1-255')
+    start = time.time()
+    out = sys.stdout
+    try:
+        for lines in generate(args.count, minwords, maxwords, minlength, maxlength, args.seed, args.unique):
+            if args.format != '%s':
+                lines = [args.format % x for x in lines]
+            out.write('\n'.join(lines))
+            out.write('\n')
+    except ValueError as e:
+        parser.error(str(e))
+    sys.stderr.write('%d lines in %.2fs\n' % (args.count, time.time() - start))
+
 if __name__ == '__main__':
-    test()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test()